@@ -0,0 +1,481 @@
+"""
+    Benchmarks for the performance sensitive parts of the bot
+"""
+
+import argparse
+import itertools
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import numpy as np
+from PIL import Image
+
+from bot import Bot
+from gb import EMULATOR_PROFILES, GameBoy
+from metrics import metrics
+from retention import directory_size
+from video import PRESETS, SCREEN_POSITION, SCREEN_SIZE, Compositor
+
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+def random_frames(count):
+    """Generates frames made of the four Game Boy shades"""
+    shades = np.array([[255, 255, 255], [170, 170, 170], [85, 85, 85], [0, 0, 0]], dtype=np.uint8)
+    rng = np.random.default_rng(0)
+    return shades[rng.integers(0, 4, size=(count, 144, 160))]
+
+
+def pil_composite(frames, gif_outline):
+    """The original PIL compositing path, decoding the outline for every frame"""
+    for frame in frames:
+        outline = Image.open(gif_outline).convert("RGB")
+        img = Image.fromarray(frame).resize(SCREEN_SIZE)
+        combined = outline.copy()
+        combined.paste(img, SCREEN_POSITION)
+        yield np.asarray(combined)
+
+
+def bench_composite(args):
+    """Compares per-frame compositing time of PIL against the Compositor"""
+    frames = random_frames(args.frames)
+    gif_outline = os.path.join(script_dir, args.outline)
+    compositor = Compositor(gif_outline)
+    paths = {
+        "pil": lambda: pil_composite(frames, gif_outline),
+        "compositor": lambda: compositor.composite(frames),
+    }
+    for name, path in paths.items():
+        start = time.perf_counter()
+        for _ in path():
+            pass
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {elapsed / len(frames) * 1000:.3f} ms/frame")
+
+
+def bench_emulation(args):
+    """Reports emulated frames per second with different capture settings"""
+    game_boy = GameBoy(args.rom)
+    modes = {
+        "capture every frame": {"stride": 1},
+        f"capture every {args.stride} frames": {"stride": args.stride},
+        "capture changed frames": {"stride": 1, "changed_only": True},
+        "no capture": {"gif": False},
+    }
+    for name, options in modes.items():
+        game_boy.frames.clear()
+        start = time.perf_counter()
+        game_boy.tick(args.frames, **options)
+        elapsed = time.perf_counter() - start
+        print(f"{name}: {args.frames / elapsed:.0f} frames/s, {len(game_boy.frames)} captured")
+
+
+def bench_profiles(args):
+    """Reports emulated frames per second with each emulator profile"""
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")  # The interactive profile opens a window
+    with tempfile.TemporaryDirectory(prefix="bench-") as data_dir:
+        rom = args.rom or build_test_rom(os.path.join(data_dir, "bench.gb"))
+        for name, profile in EMULATOR_PROFILES.items():
+            game_boy = GameBoy(rom, data_dir=data_dir, profile=profile)
+            game_boy.tick(100, gif=False)  # Past the boot animation
+            for mode, gif in (("no capture", False), ("capture every frame", True)):
+                game_boy.frames.clear()
+                start = time.perf_counter()
+                game_boy.tick(args.frames, gif=gif)
+                elapsed = time.perf_counter() - start
+                print(f"{name}, {mode}: {args.frames / elapsed:.0f} frames/s")
+            game_boy.pyboy.stop(save=False)
+
+
+def build_test_rom(path, scroll_frames=480):
+    """Writes a tiny rom that scrolls the screen for scroll_frames after any button is pressed
+
+    A stand in for a game when none is available: it sits still until a
+    button is pressed, moves, and settles again, like a turn does.
+    """
+    rom = bytearray(0x8000)
+    rom[0x100:0x104] = bytes([0x00, 0xC3, 0x50, 0x01])  # nop; jp 0x150
+    rom[0x134:0x13C] = b"BENCHROM"
+    code = bytearray([
+        0xF3,  # di
+        0xAF, 0xE0, 0x40,  # xor a; ldh (LCDC), a - turn the screen off
+        0x21, 0x00, 0x80,  # ld hl, 0x8000
+        0x06, 0x10,  # ld b, 16
+        0x3E, 0xF0,  # fill: ld a, 0xF0 - tile 0 becomes vertical stripes
+        0x22,  # ld (hl+), a
+        0x05,  # dec b
+        0x20, 0xFA,  # jr nz, fill
+        0x3E, 0xE4, 0xE0, 0x47,  # ld a, 0xE4; ldh (BGP), a
+        0x3E, 0x91, 0xE0, 0x40,  # ld a, 0x91; ldh (LCDC), a - turn the screen on
+        0x01, 0x00, 0x00,  # ld bc, 0 - frames left to scroll
+        0xF0, 0x44, 0xFE, 0x90, 0x20, 0xFA,  # frame: wait for LY == 144
+        0x3E, 0x10, 0xE0, 0x00,  # ld a, 0x10; ldh (P1), a - select the buttons
+        0xF0, 0x00, 0xF0, 0x00,  # ldh a, (P1) twice to let it settle
+        0xE6, 0x0F, 0xFE, 0x0F,  # and 0x0F; cp 0x0F
+        0x28, 0x03,  # jr z, +3 - nothing pressed
+        0x01, scroll_frames & 0xFF, scroll_frames >> 8,  # ld bc, scroll_frames
+        0x78, 0xB1,  # ld a, b; or c
+        0x28, 0x06,  # jr z, +6 - done scrolling
+        0x0B,  # dec bc
+        0xF0, 0x43, 0x3C, 0xE0, 0x43,  # ldh a, (SCX); inc a; ldh (SCX), a
+        0xF0, 0x44, 0xFE, 0x90, 0x28, 0xFA,  # wait for LY != 144
+        0x18, 0x00,  # jr frame
+    ])
+    code[-1] = (code.index(bytes([0xF0, 0x44, 0xFE, 0x90, 0x20])) - len(code)) & 0xFF
+    rom[0x150:0x150 + len(code)] = code
+    checksum = 0
+    for byte in rom[0x134:0x14D]:
+        checksum = (checksum - byte - 1) & 0xFF
+    rom[0x14D] = checksum
+    with open(path, "wb") as file:
+        file.write(rom)
+    return path
+
+
+class FakeMastodon:
+    """A local stand in for the parts of the Mastodon API a turn uses
+
+    Every poll it is asked to post comes back with its votes on the winner
+    option, so the next turn presses a button, and each poll is answered by
+    a number of replies asking for the winner too.
+
+    Args:
+        winner (str, optional): The poll option that gets the votes. Defaults to 🅰
+        replies (int, optional): Replies sent to each poll. Defaults to 0
+    """
+
+    def __init__(self, winner="🅰", replies=0):
+        self.winner = winner
+        self.replies = replies
+        self.ids = itertools.count(1)
+        self.statuses = {}
+        self.notifications = []
+        self.uploads = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        threading.Thread(
+            target=self.server.serve_forever, daemon=True, name="fake-mastodon"
+        ).start()
+
+    @property
+    def url(self):
+        """The base URL to log into"""
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def post_status(self, params):
+        """Creates a status, with a poll if one was posted"""
+        with self.lock:
+            status_id = str(next(self.ids))
+        now = datetime.now(timezone.utc)
+        status = {
+            "id": status_id,
+            "created_at": now.isoformat(),
+            "content": params.get("status", ""),
+            "poll": None,
+        }
+        if params.get("poll"):
+            expires_in = int(params["poll"].get("expires_in", 3600))
+            status["poll"] = {
+                "id": status_id,
+                "expires_at": (now + timedelta(seconds=expires_in)).isoformat(),
+                "expired": False,
+                "options": [
+                    {"title": title, "votes_count": 3 if title == self.winner else 0}
+                    for title in params["poll"]["options"]
+                ],
+            }
+            for account in range(self.replies):
+                with self.lock:
+                    notification_id = str(next(self.ids))
+                self.notifications.append({
+                    "id": notification_id,
+                    "type": "mention",
+                    "created_at": now.isoformat(),
+                    "account": {"id": str(account), "acct": f"player{account}"},
+                    "status": {
+                        "id": notification_id,
+                        "created_at": now.isoformat(),
+                        "in_reply_to_id": status_id,
+                        # The markup Mastodon renders a mention with
+                        "content": (
+                            '<p><span class="h-card" translate="no"><a href="'
+                            f'{self.url}/@bench" class="u-url mention">@<span>bench</span></a>'
+                            f"</span> {self.winner}</p>"
+                        ),
+                    },
+                })
+        self.statuses[status_id] = status
+        return status
+
+    def list_notifications(self, query):
+        """Returns a page of notifications, newest first, like the API does"""
+        limit = int(query.get("limit", ["40"])[0])
+        if "min_id" in query:
+            # The page right after min_id
+            newer = [n for n in self.notifications if int(n["id"]) > int(query["min_id"][0])]
+            return newer[:limit][::-1]
+        newer = [
+            n for n in self.notifications if int(n["id"]) > int(query.get("since_id", ["0"])[0])
+        ]
+        return newer[::-1][:limit]
+
+    def post_media(self, size):
+        """Records the size of an upload"""
+        with self.lock:
+            media_id = str(next(self.ids))
+            self.uploads.append(size)
+        return {"id": media_id, "type": "unknown", "url": None}
+
+    def handler(self):
+        """Returns the request handler class, bound to this server"""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Answers the API calls of a turn"""
+
+            def respond(self, body, status=200):
+                """Sends a JSON response"""
+                body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Reads the instance, a status or a poll"""
+                path, _, query = self.path.partition("?")
+                parts = path.strip("/").split("/")
+                if parts[2:3] == ["instance"]:
+                    self.respond({"uri": "localhost", "title": "bench", "version": "4.2.0"})
+                elif parts[2:3] == ["statuses"] and parts[3] in fake.statuses:
+                    self.respond(fake.statuses[parts[3]])
+                elif parts[2:3] == ["polls"] and parts[3] in fake.statuses:
+                    self.respond(fake.statuses[parts[3]]["poll"])
+                elif parts[2:] == ["notifications"]:
+                    self.respond(fake.list_notifications(parse_qs(query)))
+                else:
+                    self.respond({"error": "Record not found"}, 404)
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                """Uploads media, posts statuses and pins them"""
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                parts = self.path.split("?")[0].strip("/").split("/")
+                if parts[2:3] == ["media"]:
+                    self.respond(fake.post_media(len(body)))
+                elif parts[2:] == ["statuses"]:
+                    if self.headers.get("Content-Type", "").startswith("application/json"):
+                        params = json.loads(body)
+                    else:
+                        params = {
+                            key: values[0] for key, values in parse_qs(body.decode()).items()
+                        }
+                    self.respond(fake.post_status(params))
+                elif parts[2:3] == ["statuses"] and parts[3] in fake.statuses:
+                    self.respond(fake.statuses[parts[3]])  # pin and unpin
+                else:
+                    self.respond({"error": "Record not found"}, 404)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                """Keeps requests out of the console"""
+
+        return Handler
+
+    def shutdown(self):
+        """Stops the server"""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def bytes_written():
+    """Returns the bytes this process has written to storage, or None if the OS won't say"""
+    try:
+        with open("/proc/self/io", "r", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def bench_turn(args):
+    """Plays whole turns against a local fake Mastodon server and records where the time goes
+
+    The results are appended to a JSON file so runs can be compared over time.
+    """
+    fake = FakeMastodon(replies=args.replies)
+    with tempfile.TemporaryDirectory(prefix="bench-") as data_dir:
+        rom = args.rom or build_test_rom(os.path.join(data_dir, "bench.gb"))
+        bot = Bot(config={
+            "data_dir": data_dir,
+            "mastodon": {"server": fake.url, "access_token": "bench", "poll_duration": 60},
+            "gameboy": {
+                "rom": os.path.abspath(rom),
+                "title": "the benchmark rom",
+                "gif_outline": args.outline,
+                "capture_stride": args.stride,
+                "post_action_video": not args.no_video,
+                "post_recent_video": not args.no_video,
+                "encoder_process": args.encoder_process,
+            },
+            "video": {"preset": args.preset},
+            "timelapse": {"enabled": args.timelapse},
+        })
+        written = bytes_written()
+        start = time.perf_counter()
+        videos = []
+        for turn in range(args.turns):
+            results = bot.run(load=turn == 0)
+            videos.extend(
+                {"turn": turn, "video": os.path.basename(path), "bytes": os.path.getsize(path)}
+                for path in (results["action_video"], results["recent_video"])
+                if path
+            )
+        elapsed = time.perf_counter() - start
+        data_dir_bytes = directory_size(data_dir)
+    fake.shutdown()
+
+    stages = {
+        dict(labels)["stage"]: {"count": count, "mean": total / count, "max": maximum}
+        for (name, labels), (count, total, maximum) in metrics.timings.items()
+        if name == "stage"
+    }
+    if written is not None:
+        written = bytes_written() - written
+    record = {
+        "time": datetime.now(timezone.utc).isoformat(),
+        "rom": os.path.basename(args.rom) if args.rom else "test rom",
+        "turns": args.turns,
+        "capture_stride": args.stride,
+        "preset": args.preset,
+        "video": not args.no_video,
+        "encoder_process": args.encoder_process,
+        "timelapse": args.timelapse,
+        "replies": args.replies,
+        "seconds_per_turn": elapsed / args.turns,
+        "stages": stages,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "peak_encoder_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        "bytes_written": written,
+        "data_dir_bytes": data_dir_bytes,
+        "uploaded_bytes": sum(fake.uploads),
+        "videos": videos,
+    }
+
+    for stage, timing in sorted(stages.items(), key=lambda item: -item[1]["mean"]):
+        print(f"{stage}: {timing['mean']:.3f}s mean, {timing['max']:.3f}s max")
+    print(f"{record['seconds_per_turn']:.2f}s per turn, peak RSS {record['peak_rss_kb']} kB")
+
+    runs = []
+    if os.path.exists(args.output):
+        with open(args.output, "r", encoding="utf-8") as file:
+            runs = json.load(file)
+    runs.append(record)
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(runs, file, indent=2, ensure_ascii=False)
+    print(f"Results appended to {args.output}")
+
+
+def import_times(module):
+    """Imports a module in a fresh interpreter, returns the -X importtime report
+
+    Returns:
+        list: (name, nesting level, self microseconds, cumulative microseconds) of every import
+    """
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=script_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = []
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append((name.strip(), level, int(own), int(cumulative)))
+    return times
+
+
+def bench_startup(args):
+    """Reports how long the bot takes to import, and which imports take the longest"""
+    runs = [import_times(args.module) for _ in range(args.repeat)]
+    totals = [cumulative for times in runs for name, _, _, cumulative in times
+              if name == args.module]
+    print(f"import {args.module}: {statistics.median(totals) / 1000:.1f} ms median "
+          f"of {args.repeat} runs")
+    # The direct imports of the module, from the last run. Imports are reported
+    # once they finish, so they come right before the module itself
+    imports = []
+    for name, level, _, cumulative in runs[-1]:
+        if level == 0:
+            if name == args.module:
+                break
+            imports = []
+        elif level == 1:
+            imports.append((name, cumulative))
+    for name, cumulative in sorted(imports, key=lambda item: -item[1])[:args.top]:
+        print(f"  {name}: {cumulative / 1000:.1f} ms")
+
+
+def main():
+    """Runs the benchmark chosen on the command line"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(required=True)
+
+    composite = subparsers.add_parser("composite", help=bench_composite.__doc__)
+    composite.add_argument("--frames", type=int, default=240)
+    composite.add_argument("--outline", default="gameboy.png")
+    composite.set_defaults(func=bench_composite)
+
+    emulation = subparsers.add_parser("emulation", help=bench_emulation.__doc__)
+    emulation.add_argument("rom")
+    emulation.add_argument("--frames", type=int, default=1000)
+    emulation.add_argument("--stride", type=int, default=4)
+    emulation.set_defaults(func=bench_emulation)
+
+    profiles = subparsers.add_parser("profiles", help=bench_profiles.__doc__)
+    profiles.add_argument("--rom", help="Defaults to a generated test rom")
+    profiles.add_argument("--frames", type=int, default=3000)
+    profiles.set_defaults(func=bench_profiles)
+
+    turn = subparsers.add_parser("turn", help=bench_turn.__doc__.splitlines()[0])
+    turn.add_argument("--rom", help="Defaults to a generated test rom")
+    turn.add_argument("--turns", type=int, default=3)
+    turn.add_argument("--stride", type=int, default=1)
+    turn.add_argument("--outline", default="gameboy.png")
+    turn.add_argument("--preset", choices=PRESETS, default="h264")
+    turn.add_argument("--no-video", action="store_true", help="Turn off both videos")
+    turn.add_argument("--encoder-process", action="store_true",
+                      help="Encode the action video in a process fed through shared memory")
+    turn.add_argument("--timelapse", action="store_true", help="Encode timelapse segments")
+    turn.add_argument("--replies", type=int, default=0, help="Replies sent to each poll")
+    turn.add_argument("--output", default="bench_turn.json")
+    turn.set_defaults(func=bench_turn)
+
+    startup = subparsers.add_parser("startup", help=bench_startup.__doc__)
+    startup.add_argument("--module", default="bot")
+    startup.add_argument("--repeat", type=int, default=5)
+    startup.add_argument("--top", type=int, default=10)
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
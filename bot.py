@@ -2,39 +2,112 @@
     A bot that interacts with a Mastodon compatible API, plays Game Boy games via a poll
 """
 
+import argparse
 import os
 import random
 import time
+from datetime import datetime, timedelta, timezone
 
-import toml
-from mastodon import Mastodon
-from requests.exceptions import RequestException
-
-from gb import GameBoy
+from client import MastodonClient, create_session
+from gb import MIN_VIDEO_FRAMES, GameBoy, emulator_profile
+from metrics import log_to_file, metrics
+from pipeline import Pipeline
+from polls import PollWatcher
+from retention import RetentionManager
+from timelapse import Timelapse
+from video import encoding_profile
+from votes import VoteCollector
 
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
-ids_loc = os.path.join(script_dir, "ids.txt")
-gif_dir = os.path.join(script_dir, "gif_images")
 
 class Bot:
     """
     A Mastodon-API compatible bot that handles Game Boy gameplay through polls
     """
 
-    def __init__(self, config_path="config.toml"):
-        # If config_path is not provided, use the config.toml file in the same
-        # directory as the script
-        config_path = os.path.join(script_dir, "config.toml")
-        with open(config_path, "r", encoding="utf-8") as config_file:
-            self.config = toml.load(config_file)
-            self.mastodon_config = self.config.get("mastodon", {})
-            self.game_boy_config = self.config.get("gameboy", {})
+    # Poll options mapped to the GameBoy method that presses them
+    BUTTONS = {
+        "Up ⬆️": "dpad_up",
+        "Down ⬇️": "dpad_down",
+        "Right ➡️": "dpad_right",
+        "Left ⬅️": "dpad_left",
+        "🅰": "a",
+        "🅱": "b",
+        "Start": "start",
+        "Select": "select",
+    }
+
+    def __init__(self, config_path="config.toml", config=None, encode_slots=None):
+        # Relative config paths are resolved from the script directory, a
+        # config dict (one of the supervisor's instances) can be passed instead
+        if config is None:
+            import toml  # pylint: disable=import-outside-toplevel
+
+            config_path = os.path.join(script_dir, config_path)
+            with open(config_path, "r", encoding="utf-8") as config_file:
+                config = toml.load(config_file)
+        self.config = config
+        self.mastodon_config = self.config.get("mastodon", {})
+        self.game_boy_config = self.config.get("gameboy", {})
+        self.data_dir = os.path.normpath(os.path.join(script_dir, self.config.get("data_dir", "")))
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.ids_loc = os.path.join(self.data_dir, "ids.txt")
+
+        metrics_config = self.config.get("metrics", {})
+        if metrics_config.get("log"):
+            log_to_file(
+                os.path.join(self.data_dir, metrics_config["log"]),
+                max_mb=metrics_config.get("log_max_mb", 10),
+                backups=metrics_config.get("log_backups", 3),
+            )
+        if metrics_config.get("port"):
+            metrics.serve(metrics_config["port"], metrics_config.get("host", "127.0.0.1"))
 
+        self.client = MastodonClient()
         self.mastodon = self.login()
         print(self.game_boy_config.get("rom"))
         rom = os.path.join(script_dir, self.game_boy_config.get("rom"))
-        self.game_boy = GameBoy(rom, True)
+        self.game_boy = GameBoy(
+            rom,
+            capture_stride=self.game_boy_config.get("capture_stride", 1),
+            frame_capacity=self.game_boy_config.get("frame_capacity", 1024),
+            data_dir=self.data_dir,
+            encode_slots=encode_slots,
+            video_profile=encoding_profile(self.config.get("video", {})),
+            capture=self.game_boy_config.get("post_action_video", False),
+            encoder_process=self.game_boy_config.get("encoder_process", False),
+            gif_outline=self.game_boy_config.get("gif_outline", "gameboy.png"),
+            profile=emulator_profile(self.config.get("emulator", {})),
+        )
+        self.lookahead = None
+        self.poll_offset = None  # Set by serve() when several bots share the machine
+        timelapse_config = self.config.get("timelapse", {})
+        self.timelapse = None
+        if timelapse_config.get("enabled", False):
+            self.timelapse = Timelapse(
+                os.path.join(self.data_dir, "timelapse"),
+                self.game_boy.get_archive("screenshots"),
+                self.game_boy.get_compositor(self.game_boy.gif_outline),
+                fps=timelapse_config.get("fps", 5),
+                profile=encoding_profile({"preset": timelapse_config.get("preset", "h264")}),
+            )
+        retention_config = self.config.get("retention", {})
+        self.retention = RetentionManager(
+            self.data_dir,
+            self.game_boy.get_archive("screenshots"),
+            max_mb=retention_config.get("max_mb"),
+            max_age_days=retention_config.get("max_age_days"),
+            compact_batch=retention_config.get("compact_batch", 256),
+            timelapse=self.timelapse,
+        )
+        self.retention.clean_orphans()
+        self.votes = VoteCollector(
+            self.mastodon,
+            self.BUTTONS,
+            since_id=self.read_ids()[2],
+            replies=self.mastodon_config.get("reply_votes", True),
+        )
 
     def simulate(self):
         """Simulates Game Boy actions by pressing random buttons, useful for testing"""
@@ -66,10 +139,14 @@ class Bot:
 
     def login(self):
         """Logs into the Mastodon server using config credentials"""
+        from mastodon import Mastodon  # pylint: disable=import-outside-toplevel
+
         server = self.mastodon_config.get("server")
         print(f"Logging into {server}")
         return Mastodon(
-            access_token=self.mastodon_config.get("access_token"), api_base_url=server
+            access_token=self.mastodon_config.get("access_token"),
+            api_base_url=server,
+            session=create_session(self.mastodon_config.get("workers", 4)),
         )
 
     def post_poll(self, status, options, expires_in=60 * 60, reply_id=None):
@@ -81,46 +158,61 @@ class Bot:
             status, in_reply_to_id=reply_id, language="en", poll=poll
         )
 
-    def save_ids(self, post_id, poll_id):
-        """Saves post IDs to a text file"""
-        with open(ids_loc, "w", encoding="utf-8") as file:
-            file.write(f"{post_id},{poll_id}")
+    def save_ids(self, post_id, poll_ids, since_id=None):
+        """Saves the IDs of the result post and its polls, and the last mention counted"""
+        with open(self.ids_loc, "w", encoding="utf-8") as file:
+            file.write(",".join(str(post) for post in [post_id, *poll_ids]))
+            if since_id:
+                file.write(f"\n{since_id}")
 
     def read_ids(self):
-        """Reads IDs from the text file"""
+        """Reads IDs from the text file
+
+        Returns:
+            tuple: The result post ID, a list of poll IDs and the last mention counted,
+                None and an empty list if there are no posts yet
+        """
         try:
-            with open(ids_loc, "r", encoding="utf-8") as file:
-                content = file.read()
-                if content:
-                    post_id, poll_id = content.split(",")
-                    return post_id, poll_id
+            with open(self.ids_loc, "r", encoding="utf-8") as file:
+                lines = file.read().split()
         except FileNotFoundError:
-            return None, None
+            lines = []
+        if not lines:
+            return None, [], None
+        post_id, *poll_ids = lines[0].split(",")
+        return post_id, poll_ids, lines[1] if len(lines) > 1 else None
 
-        return None
+    def fetch_poll_status(self, poll_id):
+        """Fetches the status of the open poll to watch
 
-    def pin_posts(self, post_id, poll_id):
+        If it can't be fetched, the poll is taken to close poll_duration minutes
+        after ids.txt was written, so the turn still waits for it.
+        """
+        status = self.retry_mastodon_call(self.mastodon.status, poll_id)
+        if status:
+            return status
+        print("Could not fetch the poll, waiting until it should have closed")
+        posted = datetime.fromtimestamp(os.path.getmtime(self.ids_loc), timezone.utc)
+        duration = timedelta(minutes=self.mastodon_config.get("poll_duration", 60))
+        # The poll's own id is unknown, its refreshes fail and the cached copy is kept
+        poll = {"id": poll_id, "expires_at": posted + duration, "expired": False, "options": []}
+        return {"id": poll_id, "poll": poll}
+
+    def pin_posts(self, post_id, poll_ids):
         """Pin posts to profile"""
-        self.mastodon.status_pin(poll_id)
+        for poll_id in reversed(poll_ids):
+            self.mastodon.status_pin(poll_id)
         self.mastodon.status_pin(post_id)
 
-    def unpin_posts(self, post_id, poll_id):
+    def unpin_posts(self, post_id, poll_ids):
         """Unpin posts from profile"""
         self.mastodon.status_unpin(post_id)
-        self.mastodon.status_unpin(poll_id)
+        for poll_id in poll_ids:
+            self.mastodon.status_unpin(poll_id)
 
     def take_action(self, result):
         """Presses button on Game Boy based on poll result"""
-        buttons = {
-            "Up ⬆️": self.game_boy.dpad_up,
-            "Down ⬇️": self.game_boy.dpad_down,
-            "Right ➡️": self.game_boy.dpad_right,
-            "Left ⬅️": self.game_boy.dpad_left,
-            "🅰": self.game_boy.a,
-            "🅱": self.game_boy.b,
-            "Start": self.game_boy.start,
-            "Select": self.game_boy.select,
-        }
+        buttons = {title: getattr(self.game_boy, name) for title, name in self.BUTTONS.items()}
         print(buttons)
         # Perform the corresponding action
         if result in buttons:
@@ -137,83 +229,129 @@ class Bot:
             return "INVALID BUTTON"
 
     def retry_mastodon_call(self, func, *args, retries=5, interval=10, **kwargs):
-        """Continuously retries Mastodon call, useful for servers with timeout issues"""
-        for _ in range(retries):
-            try:
-                return func(*args, **kwargs)
-            except Exception as e:
-                print(f"Failure to execute {func.__name__}: {e}")
-                time.sleep(interval)
-        return False  # Failed to execute
-
-    def run(self):
-        """
-        Runs the main gameplay, reads Mastodon poll result, takes action, generates new posts
-        """
-        self.game_boy.load()
-        post_id, poll_id = self.read_ids()
-        top_result = None
+        """Retries Mastodon call with exponential backoff, useful for servers with timeout issues"""
+        return self.client.call(func, *args, retries=retries, interval=interval, **kwargs)
 
-        if post_id:
-            try:
-                self.unpin_posts(post_id, poll_id)
-            except BaseException:
-                time.sleep(30)
-                self.unpin_posts(post_id, poll_id)
-
-            poll_status = self.mastodon.status(poll_id)
-            poll_results = poll_status.poll["options"]
-            max_votes = max(map(lambda x: x["votes_count"], poll_results))
-            if max_votes == 0:
-                random_button = self.take_action("random")
-                top_result = f"Random (no votes, chose {random_button})"
-            else:
-                top_results = [x for x in poll_results if x["votes_count"] == max_votes]
-                if len(top_results) > 1:
-                    top_result = random.choice(top_results)["title"]
-                    self.take_action(top_result)
-                    top_result = f"Random (tie vote, chose {top_result})"
-                else:
-                    top_result = top_results[0]["title"]
-                    self.take_action(top_result)
+    def read_poll(self, poll_id):
+        """Fetches the options and vote counts of a poll"""
+        return self.retry_mastodon_call(self.mastodon.status, poll_id).poll["options"]
 
-        frames = self.game_boy.loop_until_stopped()
-        result = False
-        if frames >= 70:
-            result = self.game_boy.build_gif("gif_images", self.game_boy_config['gif_outline'])
-        else:
-            self.game_boy.empty_directory(gif_dir)
+    def read_votes(self, poll_ids, known=None):
+        """Adds up the votes of every poll of the turn and the commands sent in replies
 
-        image = self.game_boy.screenshot()
-        alt_text = 'Screenshot of ' + self.game_boy_config.get('title', 'a Game Boy game.')
-        media = self.retry_mastodon_call(
-          self.mastodon.media_post,
-          retries=5,
-          interval=10,
-          media_file=image,
-          description=alt_text
-        )
-        media_ids = []
-        # Probably add a check here if generating a gif is enabled (so we don't
-        # have to generate one every single hour?)
+        Args:
+            poll_ids (list): The statuses of the turn's polls
+            known (dict, optional): Final options of polls already fetched, by status ID,
+                only the other polls are fetched
+
+        Returns:
+            list: The votes for each button, in the format of a poll's options
+        """
+        known = known or {}
+        polls = [
+            {"options": known.get(poll_id) or self.read_poll(poll_id)} for poll_id in poll_ids
+        ]
+        self.retry_mastodon_call(self.votes.update)
+        results = self.votes.results(polls)
+        print(f"{len(self.votes.tally)} votes by reply")
+        self.votes.next_turn()
+        return results
+
+    def choose_action(self, poll_results):
+        """Picks the poll option to press
+
+        Returns:
+            tuple: The poll option, and a description of how it was chosen
+        """
+        max_votes = max(map(lambda x: x["votes_count"], poll_results))
+        if max_votes == 0:
+            random_button = random.choice(list(self.BUTTONS))
+            return random_button, f"Random (no votes, chose {random_button})"
+        top_results = [x for x in poll_results if x["votes_count"] == max_votes]
+        if len(top_results) > 1:
+            top_result = random.choice(top_results)["title"]
+            return top_result, f"Random (tie vote, chose {top_result})"
+        return top_results[0]["title"], top_results[0]["title"]
+
+    def play_turn(self, poll_results):
+        """Presses the winning button and lets the game settle
+
+        If the button was already played ahead while the poll was open, its
+        outcome is used instead of playing it again.
+
+        Returns:
+            tuple: A description of the action taken, the number of frames it took to settle,
+                and the lookahead Branch it came from (or None)
+        """
+        if not poll_results:
+            return None, self.game_boy.loop_until_stopped(), None
+
+        button, top_result = self.choose_action(poll_results)
+        branch = self.lookahead.commit(button, self.game_boy) if self.lookahead else None
+        if branch:
+            print(f"Using lookahead for {button}")
+            return top_result, branch.frames, branch
+        self.take_action(button)
+        return top_result, self.game_boy.loop_until_stopped(), None
+
+    def build_action_video(self, frames):
+        """Encodes the frames captured during the action if it took long enough and is posted"""
+        if frames >= MIN_VIDEO_FRAMES and self.game_boy.capture:
+            return self.game_boy.build_gif(gif_outline=self.game_boy_config['gif_outline'])
+        self.game_boy.discard_frames()
+        return False
+
+    def build_recent_video(self):
+        """Encodes the most recent screenshots, returns False if it failed or is turned off"""
+        if not self.game_boy_config.get("post_recent_video", True):
+            return False
         try:
-            previous_frames = self.game_boy.get_recent_frames("screenshots",
+            return self.game_boy.get_recent_frames("screenshots",
                 25,
                 self.game_boy_config['gif_outline']
             )
-            previous_media = self.retry_mastodon_call(
-                self.mastodon.media_post,
-                retries=5,
-                interval=10,
-                media_file=previous_frames,
-                description="Video of the previous 45 frames",
-            )
-            media_ids = [media["id"], previous_media["id"]]
-        except BaseException as e:
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            print(f"ERROR {e}")
+            return False
+
+    def collect_garbage(self):
+        """Keeps the data directory within its budget, returns the number of bytes freed"""
+        try:
+            return self.retention.collect()
+        except OSError as e:
+            print(f"ERROR {e}")
+            return 0
+
+    def update_timelapse(self):
+        """Encodes a timelapse segment once enough screenshots are pending, returns the frames
+
+        Older screenshots are caught up on one segment per turn, so no turn takes
+        much longer than the others.
+        """
+        if self.timelapse is None:
+            return 0
+        try:
+            return self.timelapse.update(max_segments=1)
+        except Exception as e:  # pylint: disable=broad-exception-caught
             print(f"ERROR {e}")
-            media_ids = [media["id"]]
+            return 0
+
+    def upload_media(self, media_file, description):
+        """Uploads a media file, returns False if there is no file or the upload failed"""
+        if not media_file:
+            return False
+        return self.retry_mastodon_call(
+            self.mastodon.media_post,
+            retries=5,
+            interval=10,
+            media_file=media_file,
+            description=description,
+        )
 
-        post = self.retry_mastodon_call(
+    def post_result(self, top_result, media, previous_media):
+        """Posts the result of the previous poll with the screenshot and recent video"""
+        media_ids = [upload["id"] for upload in (media, previous_media) if upload]
+        return self.retry_mastodon_call(
             self.mastodon.status_post,
             retries=5,
             interval=10,
@@ -224,59 +362,237 @@ class Bot:
             media_ids=[media_ids],
         )
 
+    def post_next_poll(self, post):
+        """Posts the polls for the next action, in a thread under the result post
+
+        The buttons are split over as many polls as the instance's limit on
+        options (poll_options, 4 by default) requires.
+
+        Returns:
+            list: The statuses of the polls
+        """
+        if self.votes.since_id is None:
+            # Finds where the mentions start, replies to these polls are the first counted
+            self.retry_mastodon_call(self.votes.update)
         poll_duration = self.mastodon_config.get('poll_duration', 60)
+        size = self.mastodon_config.get("poll_options", 4)
+        buttons = list(self.BUTTONS)
+        count = -(-len(buttons) // size)
+        polls = []
+        reply_id = post["id"]
+        for index in range(count):
+            part = f" ({index + 1}/{count})" if count > 1 else ""
+            poll = self.retry_mastodon_call(
+                self.post_poll,
+                retries=5,
+                interval=10,
+                status=(
+                    f"Vote on the next action{part}, or reply with a button:"
+                    "\n\n#FediPlaysPokemon"
+                ),
+                options=buttons[index * size:(index + 1) * size],
+                expires_in=self.poll_expires_in(poll_duration * 60),
+                reply_id=reply_id,
+            )
+            polls.append(poll)
+            reply_id = poll["id"]
+        return polls
 
-        poll = self.retry_mastodon_call(
-            self.post_poll,
-            retries=5,
-            interval=10,
-            status="Vote on the next action:\n\n#FediPlaysPokemon",
-            options=[
-                "Up ⬆️",
-                "Down ⬇️",
-                "Right ➡️ ",
-                "Left ⬅️",
-                "🅰",
-                "🅱",
-                "Start",
-                "Select",
-            ],
-            expires_in=poll_duration*60,
-            reply_id=post["id"],
-        )
+    def poll_expires_in(self, duration):
+        """Returns how many seconds the next poll stays open
 
+        With a poll offset, polls close offset seconds past a multiple of their
+        duration, at the one nearest a full duration from now. Each bot run by
+        the supervisor then keeps its own slot, whenever it was (re)started.
+
+        Args:
+            duration (int): The configured poll duration in seconds
+        """
+        if self.poll_offset is None:
+            return duration
+        now = time.time()
+        slot = round((now + duration - self.poll_offset) / duration) * duration
+        # Mastodon polls stay open for at least 5 minutes
+        return max(round(slot + self.poll_offset - now), 300)
+
+    def post_action_video(self, video, polls):
+        """Replies to the last poll with the video of the action, if enabled in the config"""
+        if not (video and self.game_boy_config.get("post_action_video", False)):
+            return
+        gif = self.upload_media(video, "Video of Pokémon Gold movement")
+        if not gif:
+            return
         self.retry_mastodon_call(
-            self.pin_posts,
-            retries=5,
+            self.mastodon.status_post,
+            retries=10,
             interval=10,
-            post_id=post["id"],
-            poll_id=poll["id"],
+            status="#Pokemon #FediPlaysPokemon",
+            media_ids=[gif["id"]],
+            in_reply_to_id=polls[-1]["id"],
         )
-        result = False
-        if result:
-            gif = self.retry_mastodon_call(
-                self.mastodon.media_post,
-                retries=5,
-                interval=10,
-                media_file=result,
-                description="Video of Pokémon Gold movement",
-            )
-            self.retry_mastodon_call(
-                self.mastodon.status_post,
-                retries=10,
-                interval=10,
-                status="#Pokemon #FediPlaysPokemon",
-                media_ids=[gif["id"]],
-                in_reply_to_id=poll["id"],
-            )
 
-        self.save_ids(post["id"], poll["id"])
+    def run(self, load=True, save=True, poll_results=None):
+        """
+        Runs the main gameplay, reads Mastodon poll result, takes action, generates new posts
+
+        The turn is split into stages that run as soon as the stages they depend
+        on are done, so encoding, uploads and saving overlap.
 
-        # Save game state
-        self.game_boy.save()
+        Args:
+            load (bool, optional): Loads the save state first, not needed if the emulator is warm
+            save (bool, optional): Saves the game state at the end of the turn
+            poll_results (list, optional): The votes for each button, counted if not provided
+
+        Returns:
+            dict: The results of every stage of the turn
+        """
+        post_id, poll_ids, _ = self.read_ids()
+        alt_text = 'Screenshot of ' + self.game_boy_config.get('title', 'a Game Boy game.')
+
+        pipeline = Pipeline()
+        pipeline.stage("load", self.game_boy.load if load else lambda: False)
+        if post_id:
+            pipeline.stage("unpin", lambda: self.retry_mastodon_call(
+                self.unpin_posts, post_id, poll_ids, interval=30
+            ))
+            pipeline.stage("poll", lambda: poll_results or self.read_votes(poll_ids))
+        else:
+            pipeline.stage("poll", lambda: None)
+        pipeline.stage(
+            "play", lambda poll, loaded: self.play_turn(poll), after=["poll", "load"]
+        )
+        pipeline.stage(
+            "screenshot",
+            lambda play: self.game_boy.screenshot(frame=play[2].screen if play[2] else None),
+            after=["play"],
+        )
+        if save:
+            # Only once ids.txt names the new poll, a turn that fails before then must replay
+            # from the old state or the same button would be pressed twice
+            pipeline.stage("save", lambda ids: self.game_boy.save(), after=["save_ids"])
+        pipeline.stage(
+            "action_video",
+            lambda play: play[2].video if play[2] else self.build_action_video(play[1]),
+            after=["play"],
+        )
+        pipeline.stage(
+            "recent_video", lambda image: self.build_recent_video(), after=["screenshot"]
+        )
+        # After the recent video, so the archive is not read while chunks are deleted
+        pipeline.stage("retention", lambda video: self.collect_garbage(), after=["recent_video"])
+        pipeline.stage("timelapse", lambda freed: self.update_timelapse(), after=["retention"])
+        pipeline.stage(
+            "upload_screenshot",
+            lambda image: self.upload_media(image, alt_text),
+            after=["screenshot"],
+        )
+        pipeline.stage(
+            "upload_recent_video",
+            lambda video: self.upload_media(video, "Video of the previous 45 frames"),
+            after=["recent_video"],
+        )
+        pipeline.stage(
+            "post",
+            lambda play, media, previous_media: self.post_result(play[0], media, previous_media),
+            after=["play", "upload_screenshot", "upload_recent_video"],
+        )
+        pipeline.stage("next_poll", self.post_next_poll, after=["post"])
+        pipeline.stage(
+            "pin",
+            lambda post, polls: self.retry_mastodon_call(
+                self.pin_posts, post_id=post["id"], poll_ids=[poll["id"] for poll in polls]
+            ),
+            after=["post", "next_poll"],
+        )
+        pipeline.stage(
+            "save_ids",
+            lambda post, polls: self.save_ids(
+                post["id"], [poll["id"] for poll in polls], self.votes.since_id
+            ),
+            after=["post", "next_poll"],
+        )
+        pipeline.stage("action_post", self.post_action_video, after=["action_video", "next_poll"])
+        results = pipeline.run()
+        self.game_boy.snapshots.flush()
+        return results
+
+    def serve(self, poll_offset=None):
+        """
+        Keeps playing turns with the same emulator and Mastodon session, watching each poll until
+        it closes. The game state stays in memory and is only saved every checkpoint_interval turns.
+
+        With lookahead enabled in the config, every button is played in worker
+        processes while the poll is open, so the winner's outcome is ready when it closes.
+
+        Args:
+            poll_offset (float, optional): Seconds past each multiple of the poll duration the
+                polls close at, to stagger several bots. Defaults to a full duration from posting
+        """
+        self.poll_offset = poll_offset
+        checkpoint_interval = self.game_boy_config.get("checkpoint_interval", 1)
+        grace = self.mastodon_config.get("poll_grace", 5)
+        if self.game_boy_config.get("lookahead", False):
+            # Only imported when used, it starts the process pool machinery
+            from lookahead import Lookahead  # pylint: disable=import-outside-toplevel
+
+            self.lookahead = Lookahead(
+                self.game_boy.rom,
+                self.BUTTONS,
+                workers=self.game_boy_config.get("lookahead_workers"),
+                capture_stride=self.game_boy.capture_stride,
+                data_dir=self.data_dir,
+                video_profile=self.game_boy.video_profile,
+                encode_slots=self.game_boy.encode_slots,
+                profile=self.game_boy.profile,
+            )
+
+        self.game_boy.load()
+        _, poll_ids, _ = self.read_ids()
+        poll_status = self.fetch_poll_status(poll_ids[0]) if poll_ids else None
+        turn = 0
+        try:
+            while True:
+                poll_results = None
+                if poll_status:
+                    if self.lookahead:
+                        self.lookahead.start(
+                            self.game_boy.get_state(),
+                            gif_outline=self.game_boy_config['gif_outline'],
+                            build_video=self.game_boy_config.get("post_action_video", False),
+                        )
+                    # The polls of a turn close together, so watching the first one is enough.
+                    # Replies are counted as they come in, so only the last few are left at the end
+                    options = PollWatcher(self.mastodon, poll_status).wait(
+                        grace, on_refresh=lambda: self.retry_mastodon_call(
+                            self.votes.update, retries=1
+                        )
+                    )
+                    poll_results = self.read_votes(poll_ids, known={poll_ids[0]: options})
+                turn += 1
+                state = self.game_boy.get_state()
+                try:
+                    results = self.run(
+                        load=False,
+                        save=turn % checkpoint_interval == 0,
+                        poll_results=poll_results,
+                    )
+                except BaseException:
+                    if self.read_ids()[1] == [str(poll_id) for poll_id in poll_ids]:
+                        # ids.txt still names the old poll, so the state saved on the way out
+                        # must be the one before the action or it is pressed twice
+                        self.game_boy.set_state(state)
+                    raise
+                poll_ids = [poll["id"] for poll in results["next_poll"]]
+                poll_status = results["next_poll"][0]
+        finally:
+            if self.lookahead:
+                self.lookahead.shutdown()
+            self.game_boy.save()
+            self.game_boy.snapshots.flush()
 
     def test(self):
         """Method used for testing"""
+        self.game_boy.capture = True
         self.game_boy.load()
         self.game_boy.get_recent_frames("screenshots", 25)
         # self.game_boy.build_gif("gif_images")
@@ -298,10 +614,10 @@ class Bot:
                 # self.game_boy.tick()
                 action()
                 frames = self.game_boy.loop_until_stopped()
-                if frames > 51:
-                    self.game_boy.build_gif("gif_images")
+                if frames > 306:
+                    self.game_boy.build_gif()
                 else:
-                    self.game_boy.empty_directory(gif_dir)
+                    self.game_boy.discard_frames()
             else:
                 print(f"No action defined for '{inp}'.")
             self.game_boy.save()
@@ -311,10 +627,18 @@ class Bot:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and play a turn whenever the poll closes, instead of a single turn",
+    )
+    arguments = parser.parse_args()
+
     bot = Bot()
     # bot.test()
-    bot.run()
-    # for i in range(2):
-    #    bot.run()
-    #    time.sleep(60)
+    if arguments.daemon:
+        bot.serve()
+    else:
+        bot.run()
     # bot.simulate()
@@ -0,0 +1,60 @@
+"""
+    Retries Mastodon API calls and keeps their connections alive
+"""
+
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import metrics
+
+
+def create_session(pool_size=4):
+    """Creates a requests session that keeps up to pool_size connections alive"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def backoff(attempt, interval=10, max_interval=300):
+    """Returns how long to wait before a retry, doubling each attempt with random jitter"""
+    delay = min(max_interval, interval * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class MastodonClient:
+    """Makes Mastodon calls, retrying failures with exponential backoff
+
+    Calls run on the thread that makes them, the turn's pipeline stages
+    already overlap them.
+
+    Args:
+        retries (int, optional): Attempts made before a call gives up. Defaults to 5
+        interval (float, optional): Base delay in seconds between attempts. Defaults to 10
+    """
+
+    def __init__(self, retries=5, interval=10):
+        self.retries = retries
+        self.interval = interval
+
+    def call(self, func, *args, retries=None, interval=None, **kwargs):
+        """Calls func, retrying on failure. Returns False if every attempt failed"""
+        retries = self.retries if retries is None else retries
+        interval = self.interval if interval is None else interval
+        name = func.__name__
+        with metrics.timer("mastodon_call", call=name):
+            for attempt in range(retries):
+                try:
+                    with metrics.timer("mastodon_attempt", call=name):
+                        return func(*args, **kwargs)
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    print(f"Failure to execute {name}: {e}")
+                    metrics.count("mastodon_errors", call=name)
+                    if attempt + 1 < retries:
+                        time.sleep(backoff(attempt, interval))
+        metrics.count("mastodon_failures", call=name)
+        return False  # Failed to execute
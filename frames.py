@@ -0,0 +1,127 @@
+"""
+    In-memory storage for frames captured from the Game Boy screen
+"""
+
+import numpy as np
+
+from metrics import metrics
+
+
+SCREEN_HEIGHT = 144
+SCREEN_WIDTH = 160
+SCREEN_SHAPE = (SCREEN_HEIGHT, SCREEN_WIDTH, 3)
+
+
+class FrameBuffer:
+    """A fixed size ring buffer of raw Game Boy frames
+
+    Frames are copied into a preallocated array, so capturing a frame never
+    allocates or touches the filesystem. Once the buffer is full the oldest
+    frames are overwritten, and counted in the frames_overwritten metric so
+    a capacity too small for the longest actions shows up. A frame identical
+    to the one before it is stored as a longer run of that frame instead of
+    a copy.
+
+    Args:
+        capacity (int, optional): The maximum number of frames kept. Defaults to 1024
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.frames = np.empty((capacity, *SCREEN_SHAPE), dtype=np.uint8)
+        self.runs = np.zeros(capacity, dtype=np.int64)
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.frames[(self.start + i) % self.capacity]
+
+    def append(self, frame, run=1):
+        """Copies a frame into the buffer, overwriting the oldest frame if full
+
+        Args:
+            frame (np.ndarray): The frame to copy
+            run (int, optional): Number of captures the frame stands for. Defaults to 1
+        """
+        index = (self.start + self.count) % self.capacity
+        np.copyto(self.frames[index], frame[:, :, :3])
+        self.runs[index] = run
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+            metrics.count("frames_overwritten")
+
+    def extend_run(self, run=1):
+        """Counts the latest frame as captured again, instead of storing a copy of it"""
+        self.runs[(self.start + self.count - 1) % self.capacity] += run
+
+    def run_lengths(self):
+        """Returns the number of captures each frame stands for, oldest first"""
+        return [int(self.runs[(self.start + i) % self.capacity]) for i in range(self.count)]
+
+    def latest(self):
+        """Returns the most recently captured frame, or None if the buffer is empty"""
+        if not self.count:
+            return None
+        return self.frames[(self.start + self.count - 1) % self.capacity]
+
+    def clear(self):
+        """Forgets every frame in the buffer"""
+        self.start = 0
+        self.count = 0
+
+
+class MotionDetector:
+    """Detects when the Game Boy screen has stopped changing
+
+    Each frame is compared against the frame the screen last settled on, using
+    preallocated buffers so no arrays are created per check.
+
+    Args:
+        threshold (float, optional): Percentage of pixels that must change to count as movement
+        window (int, optional): Number of frames the screen must stay still. Defaults to 90
+    """
+
+    def __init__(self, threshold=1, window=90):
+        self.threshold = threshold
+        self.window = window
+        self.reference = np.empty(SCREEN_SHAPE, dtype=np.uint8)
+        self.changed = np.empty(SCREEN_SHAPE, dtype=bool)
+        self.pixels = np.empty((SCREEN_HEIGHT, SCREEN_WIDTH), dtype=bool)
+        self.has_reference = False
+        self.still_frames = 0
+
+    def reset(self):
+        """Forgets the reference frame"""
+        self.has_reference = False
+        self.still_frames = 0
+
+    def difference(self, frame):
+        """Returns the percentage of pixels that differ from the reference frame"""
+        np.not_equal(frame[:, :, :3], self.reference, out=self.changed)
+        np.logical_or.reduce(self.changed, axis=2, out=self.pixels)
+        return np.count_nonzero(self.pixels) * 100 / self.pixels.size
+
+    def update(self, frame, elapsed=1):
+        """Checks a new frame, returns True once the screen has been still for the window
+
+        Args:
+            frame (np.ndarray): The current screen as a (144, 160, 3) array
+            elapsed (int, optional): Frames advanced since the previous check
+        """
+        if not self.has_reference:
+            np.copyto(self.reference, frame[:, :, :3])
+            self.has_reference = True
+            return False
+
+        if self.difference(frame) < self.threshold:
+            self.still_frames += elapsed
+        else:
+            np.copyto(self.reference, frame[:, :, :3])
+            self.still_frames = 0
+        return self.still_frames >= self.window
@@ -2,34 +2,124 @@
     Convenient class to interface with PyBoy
 """
 
+import io
+import itertools
+import math
 import os
 import random
-import re
-import shutil
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, fields, replace
 
 import numpy as np
-from moviepy.editor import ImageSequenceClip
 from PIL import Image
 from pyboy import PyBoy, WindowEvent
 
+from frames import FrameBuffer, MotionDetector
+from history import FrameArchive
+from metrics import metrics
+from snapshots import SnapshotStore
+from video import Compositor, EncodingProfile, repeat_runs, resample_runs, write_video
+
 
 script_dir = os.path.dirname(os.path.realpath(__file__))
-save_loc = os.path.join(script_dir, "save.state")
+# Actions that settle in fewer frames are too short to be worth a video
+MIN_VIDEO_FRAMES = 420
+
+
+@dataclass
+class EmulatorProfile:
+    """How PyBoy is set up
+
+    Args:
+        window_type (str, optional): SDL2 or OpenGL to watch the game, headless for servers.
+            Defaults to headless
+        window_scale (int, optional): Size multiplier of the window. Defaults to 1
+        sound (bool, optional): Plays the game's sound. Defaults to False
+        sound_emulated (bool, optional): Emulates the sound hardware without playing it,
+            only needed by games that wait on it. Defaults to False
+        game_wrapper (bool, optional): Loads PyBoy's helpers for the game, if it has any.
+            Defaults to False
+        emulation_speed (int, optional): Multiple of real time, 0 runs as fast as possible.
+            Defaults to 0
+    """
+
+    window_type: str = "headless"
+    window_scale: int = 1
+    sound: bool = False
+    sound_emulated: bool = False
+    game_wrapper: bool = False
+    emulation_speed: int = 0
+
+
+EMULATOR_PROFILES = {
+    "headless": EmulatorProfile(),
+    "interactive": EmulatorProfile("SDL2", window_scale=3, game_wrapper=True),
+}
+
+
+def emulator_profile(config):
+    """Builds a profile from the [emulator] section of the config
+
+    The profile (headless by default) is the starting point, any other key
+    overrides one of its settings.
+    """
+    config = dict(config)
+    profile = EMULATOR_PROFILES[config.pop("profile", "headless")]
+    known = {field.name for field in fields(EmulatorProfile)}
+    unknown = set(config) - known
+    if unknown:
+        raise ValueError(f"Unknown [emulator] settings: {', '.join(sorted(unknown))}")
+    return replace(profile, **config)
+
 
 class GameBoy:
     """Provides an easy way to interface with PyBoy
 
     Args:
         rom (str): A string pointing to a rom file (MUST be GB or GBC, no GBA files)
-        debug (bool, optional): Enable debug mode. Defaults to false
+        debug (bool, optional): Opens a window to watch the game, the interactive profile.
+            Defaults to false
+        frame_capacity (int, optional): Maximum number of frames kept in memory for the gif
+        capture_stride (int, optional): Captures every n-th frame for the gif. Defaults to 1
+        data_dir (str, optional): Where screenshots, videos and save states are written.
+            Defaults to the script directory
+        encode_slots (Semaphore, optional): Limits how many videos are encoded at once
+        video_profile (EncodingProfile, optional): How videos are encoded. Defaults to H.264
+        capture (bool, optional): Captures frames for videos as the game is played, turned off
+            when no video is made so frames are neither copied nor rendered. Defaults to True
+        encoder_process (bool, optional): Streams captured frames through shared memory to an
+            encoder process, so the action video is encoded while the game plays.
+            Defaults to False
+        gif_outline (str, optional): File name of the outline the encoder process uses
+        profile (EmulatorProfile, optional): How PyBoy is set up, replaces debug. Defaults to
+            the interactive profile in debug mode and the headless one otherwise
     """
 
-    def __init__(self, rom, debug=False):
+    def __init__(self, rom, debug=False, frame_capacity=1024, capture_stride=1,
+                 data_dir=script_dir, encode_slots=None, video_profile=None, capture=True,
+                 encoder_process=False, gif_outline="gameboy.png", profile=None):
         self.debug = debug
+        self.profile = profile or EMULATOR_PROFILES["interactive" if debug else "headless"]
         self.rom = rom
+        self.data_dir = data_dir
+        self.encode_slots = encode_slots
+        self.video_profile = video_profile or EncodingProfile()
         self.running = False
         self.pyboy = self.load_rom(self.rom)
-        self.pyboy.set_emulation_speed(0)
+        self.pyboy.set_emulation_speed(self.profile.emulation_speed)
+        self.screen = self.pyboy.botsupport_manager().screen()
+        self.frames = FrameBuffer(frame_capacity)
+        self.capture = capture
+        self.capture_stride = capture_stride
+        self.encoder_process = encoder_process
+        self.encoder = None
+        self.gif_outline = gif_outline
+        self.frame_count = 0
+        self.rendering = True
+        self.compositors = {}
+        self.archives = {}
+        self.snapshots = SnapshotStore(os.path.join(data_dir, "states"))
 
     def is_running(self):
         """Returns True if bot is running in constant loop mode, false otherwise"""
@@ -41,55 +131,122 @@ class GameBoy:
         while True:
             self.random_button()
 
-    def tick(self, ticks=1, gif=True):
+    def tick(self, ticks=1, gif=None, stride=None, changed_only=False):
         """Advances the Game Boy by a specified number of frames.
 
+        Frames that are not captured are not rendered either, except for the
+        last one so the screen is always current afterwards.
+
         Args:
             ticks (int, optional): The number of frames to advance. Defaults to 1
-            gif (bool, optional): Generates screenshots for the gif if True
+            gif (bool, optional): Captures frames for the gif if True. Defaults to capture
+            stride (int, optional): Captures every stride-th frame. Defaults to capture_stride
+            changed_only (bool, optional): Drops frames identical to the last captured one,
+                by default they lengthen its run so the video keeps the same timing
         """
-        for _ in range(ticks):
-            if gif:
-                self.screenshot("gif_images")
-            self.pyboy.tick()
+        stride = stride or self.capture_stride
+        gif = self.capture if gif is None else gif
+        frames = self.capture_target() if gif else None
+        pyboy = self.pyboy
+        start = time.perf_counter()
+        capture_time = 0
+        captured = 0
+        repeated = 0
+        for remaining in range(ticks - 1, -1, -1):
+            capture = gif and self.frame_count % stride == 0
+            self.set_rendering(capture or not remaining)
+            pyboy.tick()
+            self.frame_count += 1
+            if capture:
+                capture_start = time.perf_counter()
+                frame = self.screen.screen_ndarray()
+                latest = frames.latest()
+                if latest is None or not np.array_equal(frame[:, :, :3], latest):
+                    frames.append(frame)
+                    captured += 1
+                elif not changed_only:
+                    frames.extend_run()
+                    repeated += 1
+                capture_time += time.perf_counter() - capture_start
+        # Counted rather than logged, tick() is called far too often to log every call
+        metrics.count("emulation_seconds", time.perf_counter() - start - capture_time)
+        metrics.count("frames_emulated", ticks)
+        metrics.count("capture_seconds", capture_time)
+        metrics.count("frames_captured", captured)
+        metrics.count("frames_repeated", repeated)
+
+    def capture_target(self):
+        """Returns where captured frames go, the encoder's slab when encoding in a process"""
+        if not self.encoder_process:
+            return self.frames
+        if self.encoder is None:
+            self.start_encoder()
+        return self.encoder.slab
+
+    def start_encoder(self):
+        """Starts the encoder process for the next action video"""
+        # Only imported when used, it brings in the multiprocessing machinery
+        from slab import SlabEncoder  # pylint: disable=import-outside-toplevel
+
+        fps = 120 / self.capture_stride
+        save_path = os.path.join(self.data_dir, "action" + self.video_profile.extension)
+        self.encoder = SlabEncoder(
+            save_path, fps, self.video_profile, os.path.join(script_dir, self.gif_outline)
+        )
 
-    def compare_frames(self, frame1, frame2):
-        """
-        Compares two frames from Game Boy screenshot, returns a percentage difference between the two
-        """
-        arr1 = np.array(frame1)
-        arr2 = np.array(frame2)
+    def finish_encoder(self, save_path=None):
+        """Waits for the encoder process to write the captured frames and starts the next one
 
-        diff = np.abs(arr1 - arr2)
-        changed_pixels = np.count_nonzero(diff)
-        percent = (changed_pixels / diff.size) * 100
-        print(f"Pixels: {changed_pixels} {percent}%")
-        return percent
+        Args:
+            save_path (str, optional): Moves the video there. Defaults to deleting it
 
-    def get_recent_frames(self, directory, num_frames=100, gif_outline='gameboy.png'):
-        """Gets the most recent frames from a provided directory"""
-        screenshot_dir = os.path.join(script_dir, directory)
-        # Probably should replace this with heap (especially since there are so
-        # many image files)
-        image_files = [
-            os.path.join(screenshot_dir, i) for i in os.listdir(screenshot_dir)
-        ]
-        image_files.sort(key=os.path.getmtime)
-        latest = image_files[-(num_frames):]
+        Returns:
+            The path to the video, or False if there were no frames
+        """
+        if self.encoder is None:
+            return False
+        encoder, self.encoder = self.encoder, None
+        # Most of the video is encoded while the game plays, the rest takes a slot
+        with self.encode_slots or nullcontext():
+            video = encoder.finish()
+        if self.capture:
+            # Spawning the process and its imports overlap the rest of the turn
+            self.start_encoder()
+        if not video:
+            return False
+        if save_path is None:
+            os.remove(video)
+            return False
+        if video != save_path:
+            os.replace(video, save_path)
+        return save_path
+
+    def discard_frames(self):
+        """Drops the captured frames, and the video being encoded from them"""
+        self.frames.clear()
+        self.finish_encoder()
+
+    def set_rendering(self, rendering):
+        """Turns rendering of the Game Boy screen on or off"""
+        if rendering != self.rendering:
+            self.pyboy._rendering(rendering)  # pylint: disable=protected-access
+            self.rendering = rendering
 
-        count = 0
-        for image in latest:
-            print(image)
-            count += 1
-            shutil.copy(image, os.path.join(script_dir, "tmp", f"{count}.png"))
+    def get_recent_frames(self, directory, num_frames=100, gif_outline='gameboy.png'):
+        """Builds a video from the most recent frames in a provided directory"""
+        frames = self.get_archive(directory).tail(num_frames)
 
-        self.build_gif(os.path.join(script_dir, "tmp"),
+        return self.build_gif(frames,
             fps=5,
             output_name="test.mp4",
             gif_outline=gif_outline
         )
-        self.empty_directory(os.path.join(script_dir, "tmp"))
-        return os.path.join(script_dir, "test.mp4")
+
+    def get_archive(self, directory):
+        """Returns the frame archive of a screenshot directory, creating it on first use"""
+        if directory not in self.archives:
+            self.archives[directory] = FrameArchive(os.path.join(self.data_dir, directory))
+        return self.archives[directory]
 
     def empty_directory(self, directory):
         """Deletes all images in the provided directory"""
@@ -101,53 +258,88 @@ class GameBoy:
         for img in image_files:
             os.remove(os.path.join(directory, img))
 
-    def build_gif(self, image_path, delete=True, fps=120, output_name="action.mp4", gif_outline="gameboy.png"):
-        """Build a gif from a folder of images"""
-        gif_dir = os.path.join(script_dir, image_path)
-        image_files = [
-            i for i in os.listdir(gif_dir) if os.path.isfile(os.path.join(gif_dir, i))
-        ]
-        # image_files.sort()
-        image_files.sort(key=lambda x: int("".join(filter(str.isdigit, x))))
-        images = []
-        print(len(image_files))
-        for file in image_files:
-
-            game_boy_outline = Image.open(
-                os.path.join(script_dir, gif_outline)
-            ).convert("RGB")
-            img = Image.open(os.path.join(gif_dir, file)).convert("RGB")
-            img = img.resize((822, 733))
-            combined = game_boy_outline.copy()
-            combined.paste(img, (370, 319)) #370, 319 1192, 1052    
-            combined.save(os.path.join(gif_dir, file))
-            images.append(os.path.join(gif_dir, file))
-
-        if images:
-            save_path = None
-            frames = images
-            save_path = os.path.join(script_dir, output_name)
-            clip = ImageSequenceClip(frames, fps=fps)
-            clip.write_videofile(save_path, codec="libx264")
-            if delete:
-                for img in images:
-                    os.remove(img)
-            return save_path
+    def build_gif(self, frames=None, fps=120, output_name="action.mp4", gif_outline="gameboy.png"):
+        """Streams frames onto the Game Boy outline and into a video
 
-        return False
+        Args:
+            frames (iterable, optional): Frames to encode. Defaults to the captured frames,
+                which are cleared afterwards
+            fps (int, optional): Frames per second of the video. Defaults to 120, divided by
+                capture_stride for the captured frames so they play back in real time
+            output_name (str, optional): File name of the video, its extension is replaced by
+                the one of the video format. Defaults to action.mp4
+            gif_outline (str, optional): File name of the Game Boy outline image, the encoder
+                process uses the one given to the constructor
+
+        Returns:
+            The path to the video, or False if there were no frames
+        """
+        profile = self.video_profile
+        output_name = os.path.splitext(output_name)[0] + profile.extension
+        save_path = os.path.join(self.data_dir, output_name)
+        if frames is None and self.encoder_process:
+            return self.finish_encoder(save_path)
+        compositor = self.get_compositor(gif_outline)
+        captured = frames is None
+        if captured:
+            fps /= self.capture_stride
+        # Frames over the profile's rate are dropped before they are composited
+        step = math.ceil(fps / profile.max_fps) if profile.max_fps else 1
+        if captured:
+            # Each run of identical frames is composited once and repeated, ffmpeg then
+            # turns the repeats into a longer frame. Runs longer than max_still are cut short.
+            runs = self.frames.run_lengths()
+            if profile.max_still:
+                longest = max(int(profile.max_still * fps), 1)
+                runs = [min(run, longest) for run in runs]
+            runs = resample_runs(runs, step)
+            shown = [run for run in runs if run]
+            frame_count = sum(shown)
+            hold = shown.pop() - 1 if shown else 0
+            shown.append(1)
+            video = repeat_runs(compositor.composite(itertools.compress(self.frames, runs)), shown)
+            drop_duplicates = len(shown) < frame_count - hold
+        else:
+            frame_count = -(-len(frames) // step) if hasattr(frames, "__len__") else None
+            video = compositor.composite(itertools.islice(frames, 0, None, step))
+            drop_duplicates = False
+            hold = 0
+        with self.encode_slots or nullcontext(), metrics.timer("encode", video=output_name):
+            count = write_video(
+                video,
+                save_path,
+                fps=fps / step,
+                profile=profile,
+                frame_count=frame_count,
+                drop_duplicates=drop_duplicates,
+                hold=hold * step / fps,
+            )
+        print(count)
+        if captured:
+            self.frames.clear()
+        return save_path if count else False
+
+    def get_compositor(self, gif_outline):
+        """Returns the compositor for an outline, creating it on first use"""
+        if gif_outline not in self.compositors:
+            self.compositors[gif_outline] = Compositor(os.path.join(script_dir, gif_outline))
+        return self.compositors[gif_outline]
 
     def stop(self):
         """Stops the continuous Game Boy loop"""
         self.running = False
 
     def load_rom(self, rom):
-        """Loads the rom into a PyBoy object"""
+        """Loads the rom into a PyBoy object set up by the emulator profile"""
+        profile = self.profile
         return PyBoy(
             rom,
-            window_type="SDL2" if self.debug else "headless",
-            window_scale=3,
+            window_type=profile.window_type,
+            window_scale=profile.window_scale,
+            sound=profile.sound,
+            sound_emulated=profile.sound_emulated,
             debug=False,
-            game_wrapper=True,
+            game_wrapper=profile.game_wrapper,
         )
 
     def dpad_up(self) -> None:
@@ -211,26 +403,19 @@ class GameBoy:
         self.tick(3)
         self.pyboy.send_input(WindowEvent.RELEASE_BUTTON_SELECT)
 
-    def screenshot(self, path="screenshots"):
-        """Takes a screenshot of Game Boy screen and saves it to the path"""
-        screenshot_dir = os.path.join(script_dir, path)
-        # Create screenshots directory if it doesn't exist
-        os.makedirs(screenshot_dir, exist_ok=True)
-
-        # Get existing screenshot numbers
-        screenshot_numbers = [
-            int(re.search(r"screenshot_(\d+)\.png", filename).group(1))
-            for filename in os.listdir(screenshot_dir)
-            if re.match(r"screenshot_\d+\.png", filename)
-        ]
-        next_number = max(screenshot_numbers, default=0) + 1
-
-        # Save the screenshot with the next available number
-        screenshot_path = os.path.join(screenshot_dir, f"screenshot_{next_number}.png")
-        screenshot_path_full = os.path.join(script_dir, "screenshot.png")
-        self.pyboy.screen_image().save(screenshot_path_full)
-        # Copy the screenshot to the screenshots directory
-        shutil.copyfile(screenshot_path_full, screenshot_path)
+    def screenshot(self, path="screenshots", frame=None):
+        """Takes a screenshot of Game Boy screen and adds it to the archive at the path
+
+        Args:
+            path (str, optional): The screenshot archive directory. Defaults to screenshots
+            frame (np.ndarray, optional): Saves this frame instead of the current screen
+        """
+        with metrics.timer("screenshot"):
+            if frame is None:
+                frame = self.screen.screen_ndarray()
+            screenshot_path_full = os.path.join(self.data_dir, "screenshot.png")
+            Image.fromarray(frame).save(screenshot_path_full)
+            self.get_archive(path).append(frame)
         return screenshot_path_full
 
     def random_button(self):
@@ -249,48 +434,68 @@ class GameBoy:
         )
         button()
 
-    def load(self):
-        """Loads the save state"""
-        result = False
-        if os.path.exists(save_loc):
-            with open(save_loc, "rb") as file:
-                self.pyboy.load_state(file)
-            result = True
-        else:
-            print("Save state does not exist")
-        return result
-
-    def save(self):
-        """Saves current state to a file"""
-        with open(save_loc, "wb") as file:
-            self.pyboy.save_state(file)
-
-    def loop_until_stopped(self, threshold=1):
-        """Simulates the Game Boy bot"""
-        running = True
-        previous_frame = None
-        current_frame = None
+    def load(self, turn=None):
+        """Loads the save state of a turn, the latest one by default
+
+        Falls back to the save.state file written by older versions.
+        """
+        with metrics.timer("load"):
+            if self.snapshots.restore(self.pyboy, turn):
+                return True
+            save_loc = os.path.join(self.data_dir, "save.state")
+            if turn is None and os.path.exists(save_loc):
+                with open(save_loc, "rb") as file:
+                    self.pyboy.load_state(file)
+                return True
+        print("Save state does not exist")
+        return False
+
+    def get_state(self):
+        """Returns the current save state as bytes"""
+        state = io.BytesIO()
+        self.pyboy.save_state(state)
+        return state.getvalue()
+
+    def set_state(self, state):
+        """Loads a save state returned by get_state"""
+        self.pyboy.load_state(io.BytesIO(state))
+
+    def save(self, turn=None):
+        """Snapshots the current state, it is checkpointed to disk in the background
+
+        Args:
+            turn (int, optional): The turn number. Defaults to the turn after the latest one
+
+        Returns:
+            int: The turn number of the snapshot
+        """
+        with metrics.timer("save"):
+            return self.snapshots.take(self.pyboy, turn)
+
+    def loop_until_stopped(self, threshold=1, interval=5, window=90, max_frames=6000):
+        """Advances the Game Boy until the screen stops changing
+
+        Args:
+            threshold (float, optional): Percentage of pixels that must change to count as movement
+            interval (int, optional): Number of frames between checks. Defaults to 5
+            window (int, optional): Number of frames the screen must stay still. Defaults to 90
+            max_frames (int, optional): Gives up after this many frames. Defaults to 6000
+
+        Returns:
+            int: The number of frames advanced, or 0 if the screen never settled
+        """
+        detector = MotionDetector(threshold, window)
         count = 0
-        no_movement = 0
-        while running:
-            previous_frame = current_frame
-            self.tick(30)
-            count += 5
-            current_frame = Image.open(
-                os.path.join(script_dir, "screenshot.png")
-            ).convert("L")
-            if previous_frame:
-                diff = self.compare_frames(previous_frame, current_frame)
-                print(f"Frame {count}: {diff}")
-                if diff < threshold:
-                    no_movement += 1
-                else:
-                    no_movement = 0
-            if no_movement > 3:
-                running = False
-            if (
-                count > 1000
-            ):  # Shouldn't have lasted this long, something has gone wrong
-                print("Error")
-                return 0
-        return count
+        with metrics.timer("settle"):
+            while True:
+                self.tick(interval)
+                count += interval
+                if detector.update(self.screen.screen_ndarray(), interval):
+                    print(f"Settled after {count} frames")
+                    metrics.count("settle_frames", count)
+                    return count
+                if count > max_frames:
+                    # Shouldn't have lasted this long, something has gone wrong
+                    print("Error")
+                    metrics.count("settle_failures")
+                    return 0
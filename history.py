@@ -0,0 +1,399 @@
+"""
+    Keeps track of every screenshot the bot has taken
+"""
+
+import argparse
+import mmap
+import os
+import re
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+from frames import SCREEN_HEIGHT, SCREEN_SHAPE, SCREEN_WIDTH
+from video import PRESETS, Compositor, write_video
+
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+class FrameIndex:
+    """An append-only index mapping screenshot numbers to where they are stored
+
+    Every record has the same size, so the most recent frames are read by
+    seeking from the end of the file instead of listing the directory.
+
+    Args:
+        directory (str): The directory holding the screenshots and the index
+        filename (str, optional): Name of the index file. Defaults to index.bin
+    """
+
+    RECORD = struct.Struct("<Q48sQ")  # number, file name, offset into the file
+    PATTERN = re.compile(r"screenshot_(\d+)\.png")
+
+    def __init__(self, directory, filename="index.bin"):
+        self.directory = directory
+        self.path = os.path.join(directory, filename)
+        os.makedirs(directory, exist_ok=True)
+        if not os.path.exists(self.path):
+            self.rebuild()
+
+    def __len__(self):
+        return os.path.getsize(self.path) // self.RECORD.size
+
+    def rebuild(self):
+        """Recreates the index from the screenshots already in the directory"""
+        numbers = sorted(
+            int(match.group(1))
+            for match in map(self.PATTERN.fullmatch, os.listdir(self.directory))
+            if match
+        )
+        self.write((number, f"screenshot_{number}.png", 0) for number in numbers)
+
+    def pack(self, number, name, offset=0):
+        """Packs a single index record"""
+        return self.RECORD.pack(number, name.encode("utf-8"), offset)
+
+    def unpack(self, data):
+        """Unpacks a single index record into (number, path, offset)"""
+        number, name, offset = self.RECORD.unpack(data)
+        name = name.rstrip(b"\0").decode("utf-8")
+        return number, os.path.join(self.directory, name), offset
+
+    def records(self):
+        """Returns every record in the index, oldest first"""
+        with open(self.path, "rb") as file:
+            data = file.read()
+        size = self.RECORD.size
+        return [self.unpack(data[i:i + size]) for i in range(0, len(data) - size + 1, size)]
+
+    def write(self, records):
+        """Atomically replaces the index with the provided (number, name, offset) records"""
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as file:
+            for number, name, offset in records:
+                file.write(self.pack(number, os.path.basename(name), offset))
+        os.replace(temp_path, self.path)
+
+    def append(self, number, name, offset=0):
+        """Adds a record to the end of the index"""
+        with open(self.path, "ab") as file:
+            file.write(self.pack(number, name, offset))
+
+    def tail(self, count):
+        """Returns the last count records, oldest first"""
+        size = self.RECORD.size
+        with open(self.path, "rb") as file:
+            file.seek(0, os.SEEK_END)
+            start = max(file.tell() - count * size, 0)
+            start -= start % size
+            file.seek(start)
+            data = file.read()
+        return [self.unpack(data[i:i + size]) for i in range(0, len(data) - size + 1, size)]
+
+    def last_number(self):
+        """Returns the number of the newest screenshot, 0 if there are none"""
+        records = self.tail(1)
+        return records[0][0] if records else 0
+
+
+class FrameArchive:
+    """Stores screenshots in compressed chunk files instead of one PNG each
+
+    Each frame is stored as a palette and an array of palette indices. Frames
+    that share the previous frame's palette store their indices XORed with the
+    previous frame, so unchanged pixels compress to almost nothing. Chunks are
+    only appended to, and are read back through a memory map.
+
+    Screenshots saved as PNGs by older versions stay readable through the index,
+    until compact() moves them into legacy chunks. Those sort before the other
+    chunks, so they are the first to be rotated out.
+
+    Args:
+        directory (str): The directory holding the chunks and the index
+        chunk_frames (int, optional): Number of frames per chunk. Defaults to 256
+        max_chunks (int, optional): Oldest chunks beyond this are deleted. Defaults to None
+    """
+
+    HEADER = struct.Struct("<QBHI")  # number, kind, palette size, payload size
+    KEY, DELTA, RAW = range(3)
+    CHUNK_PATTERN = re.compile(r"(chunk|legacy)_(\d+)\.frames")
+
+    def __init__(self, directory, chunk_frames=256, max_chunks=None):
+        self.directory = directory
+        self.chunk_frames = chunk_frames
+        self.max_chunks = max_chunks
+        os.makedirs(directory, exist_ok=True)
+        rebuild = not os.path.exists(os.path.join(directory, "index.bin"))
+        self.index = FrameIndex(directory)
+        if rebuild and self.chunks():
+            self.rebuild_index()
+
+        self.chunk = None
+        self.chunk_count = 0
+        self.previous = None  # (palette, indices) of the last appended frame
+
+    def chunks(self):
+        """Returns the chunk file names, oldest first"""
+        def order(name):
+            kind, number = self.CHUNK_PATTERN.fullmatch(name).groups()
+            return kind == "chunk", int(number)
+
+        return sorted(
+            (name for name in os.listdir(self.directory) if self.CHUNK_PATTERN.fullmatch(name)),
+            key=order,
+        )
+
+    def rebuild_index(self):
+        """Recreates the index from the PNG screenshots and the chunks in the directory"""
+        records = self.index.records()
+        for chunk in self.chunks():
+            path = os.path.join(self.directory, chunk)
+            records.extend((number, path, offset) for number, offset, _ in self.scan(path))
+        records.sort()
+        self.index.write(records)
+
+    def encode(self, number, frame, previous=None):
+        """Encodes a frame into a record, returns the record and the frame's (palette, indices)
+
+        Args:
+            number (int): The screenshot number
+            frame (np.ndarray): The frame to encode
+            previous (tuple, optional): The (palette, indices) of the frame before it in the chunk
+        """
+        rgb = frame[:, :, :3].astype(np.uint32)
+        packed = (rgb[:, :, 0] << 16) | (rgb[:, :, 1] << 8) | rgb[:, :, 2]
+        colors, indices = np.unique(packed, return_inverse=True)
+        if len(colors) > 256:
+            payload = zlib.compress(np.ascontiguousarray(frame[:, :, :3]).tobytes())
+            return self.HEADER.pack(number, self.RAW, 0, len(payload)) + payload, None
+
+        indices = indices.reshape(SCREEN_HEIGHT, SCREEN_WIDTH).astype(np.uint8)
+        palette = np.stack([colors >> 16, (colors >> 8) & 0xFF, colors & 0xFF], axis=1)
+        palette = palette.astype(np.uint8).tobytes()
+        kind, data = self.KEY, indices
+        if previous is not None and previous[0] == palette:
+            kind, data = self.DELTA, indices ^ previous[1]
+        payload = zlib.compress(data.tobytes())
+        header = self.HEADER.pack(number, kind, len(colors), len(payload))
+        return header + palette + payload, (palette, indices)
+
+    def decode(self, data, offset, previous):
+        """Decodes the record at offset, returns (frame, (palette, indices), next offset)"""
+        _, kind, colors, length = self.HEADER.unpack_from(data, offset)
+        start = offset + self.HEADER.size + colors * 3
+        payload = zlib.decompress(data[start:start + length])
+        if kind == self.RAW:
+            frame = np.frombuffer(payload, dtype=np.uint8).reshape(SCREEN_SHAPE)
+            return frame, None, start + length
+
+        palette = data[offset + self.HEADER.size:start]
+        indices = np.frombuffer(payload, dtype=np.uint8).reshape(SCREEN_HEIGHT, SCREEN_WIDTH)
+        if kind == self.DELTA:
+            indices = indices ^ previous[1]
+        colors = np.frombuffer(palette, dtype=np.uint8).reshape(-1, 3)
+        return colors[indices], (palette, indices), start + length
+
+    def scan(self, path):
+        """Yields (number, offset, kind) for every record in a chunk without decoding it"""
+        with open(path, "rb") as file:
+            if not os.fstat(file.fileno()).st_size:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = 0
+                while offset < len(data):
+                    number, kind, colors, length = self.HEADER.unpack_from(data, offset)
+                    yield number, offset, kind
+                    offset += self.HEADER.size + colors * 3 + length
+
+    def resume(self):
+        """Continues the newest chunk, decoding its last frame so deltas can follow it"""
+        chunks = [chunk for chunk in self.chunks() if chunk.startswith("chunk_")]
+        if not chunks:
+            self.start_chunk(0)
+            return
+        self.chunk = os.path.join(self.directory, chunks[-1])
+        records = list(self.scan(self.chunk))
+        self.chunk_count = len(records)
+        if records:
+            _, frame_state = self.read_chunk(self.chunk, [records[-1][1]])
+            self.previous = frame_state
+
+    def start_chunk(self, number):
+        """Starts writing to a new chunk, deleting the oldest chunks if over max_chunks"""
+        self.chunk = os.path.join(self.directory, f"chunk_{number:06d}.frames")
+        self.chunk_count = 0
+        self.previous = None
+        if self.max_chunks is not None:
+            # The new chunk does not exist yet, so leave room for it
+            self.rotate(max(self.max_chunks - 1, 0))
+
+    def append(self, frame):
+        """Adds a frame to the archive, returns its screenshot number"""
+        if self.chunk is None:
+            self.resume()
+        if self.chunk_count >= self.chunk_frames:
+            current = int(self.CHUNK_PATTERN.fullmatch(os.path.basename(self.chunk)).group(2))
+            self.start_chunk(current + 1)
+
+        number = self.index.last_number() + 1
+        record, self.previous = self.encode(number, frame, self.previous)
+        with open(self.chunk, "ab") as file:
+            offset = file.tell()
+            file.write(record)
+        self.index.append(number, os.path.basename(self.chunk), offset)
+        self.chunk_count += 1
+        return number
+
+    def read_chunk(self, path, offsets):
+        """Decodes the frames at the provided offsets of a chunk
+
+        Returns:
+            tuple: The list of frames in offset order, and the (palette, indices) of the last one
+        """
+        wanted = sorted(offsets)
+        records = [(offset, kind) for _, offset, kind in self.scan(path) if offset <= wanted[-1]]
+        # Deltas depend on every frame since the last key frame
+        start = max(
+            (offset for offset, kind in records if kind != self.DELTA and offset <= wanted[0]),
+            default=0,
+        )
+        frames = []
+        previous = None
+        with open(path, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = start
+                while offset <= wanted[-1]:
+                    frame, previous, next_offset = self.decode(data, offset, previous)
+                    if offset in offsets:
+                        frames.append(frame)
+                    offset = next_offset
+        return frames, previous
+
+    def read(self, records):
+        """Yields the frames for the provided index records, in order"""
+        i = 0
+        while i < len(records):
+            path = records[i][1]
+            if path.endswith(".png"):
+                yield np.asarray(Image.open(path).convert("RGB"))
+                i += 1
+                continue
+            # Decode every requested frame of this chunk in one pass
+            j = i
+            while j < len(records) and records[j][1] == path:
+                j += 1
+            frames, _ = self.read_chunk(path, {offset for _, _, offset in records[i:j]})
+            yield from frames
+            i = j
+
+    def tail(self, count):
+        """Yields the most recent count frames, oldest first"""
+        return self.read(self.index.tail(count))
+
+    def between(self, start, end):
+        """Yields the frames numbered start to end (inclusive)"""
+        return self.read([record for record in self.index.records() if start <= record[0] <= end])
+
+    def compact(self, limit=256):
+        """Moves the oldest PNG screenshots into a new legacy chunk
+
+        Args:
+            limit (int, optional): Most screenshots moved at once. Defaults to 256
+
+        Returns:
+            int: The number of bytes freed
+        """
+        records = self.index.records()
+        batch = [record for record in records if record[1].endswith(".png")][:limit]
+        if not batch:
+            return 0
+        legacy = [
+            int(self.CHUNK_PATTERN.fullmatch(chunk).group(2))
+            for chunk in self.chunks()
+            if chunk.startswith("legacy_")
+        ]
+        path = os.path.join(self.directory, f"legacy_{max(legacy, default=-1) + 1:06d}.frames")
+        offsets = {}
+        previous = None
+        with open(f"{path}.tmp", "wb") as file:
+            for number, png, _ in batch:
+                if os.path.exists(png):
+                    offsets[number] = file.tell()
+                    frame = np.asarray(Image.open(png).convert("RGB"))
+                    record, previous = self.encode(number, frame, previous)
+                    file.write(record)
+        if offsets:
+            os.replace(f"{path}.tmp", path)
+        else:
+            os.remove(f"{path}.tmp")
+
+        # Screenshots whose PNG is missing are dropped from the index
+        moved = {number for number, _, _ in batch}
+        self.index.write(
+            (number, path, offsets[number]) if number in offsets else (number, name, offset)
+            for number, name, offset in records
+            if number not in moved or number in offsets
+        )
+        freed = -os.path.getsize(path) if offsets else 0
+        for _, png, _ in batch:
+            if os.path.exists(png):
+                freed += os.path.getsize(png)
+                os.remove(png)
+        return freed
+
+    def rotate(self, keep):
+        """Deletes all but the newest keep chunks, returns the number of bytes freed"""
+        chunks = [os.path.join(self.directory, chunk) for chunk in self.chunks()]
+        removed = {path for path in chunks[:max(len(chunks) - keep, 0)] if path != self.chunk}
+        if not removed:
+            return 0
+        self.index.write(record for record in self.index.records() if record[1] not in removed)
+        freed = 0
+        for path in removed:
+            freed += os.path.getsize(path)
+            os.remove(path)
+        return freed
+
+
+def main():
+    """Command line interface for exporting and rotating archived screenshots"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--directory", default=os.path.join(script_dir, "screenshots"))
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    export = subparsers.add_parser("export", help="Export a range of screenshots to a video")
+    export.add_argument("start", type=int)
+    export.add_argument("end", type=int)
+    export.add_argument("output")
+    export.add_argument("--fps", type=int, default=5)
+    export.add_argument("--outline", default=os.path.join(script_dir, "gameboy.png"))
+    export.add_argument("--preset", choices=PRESETS, help="Defaults to the output's extension")
+
+    rotate = subparsers.add_parser("rotate", help="Delete all but the newest chunks")
+    rotate.add_argument("keep", type=int)
+
+    compact = subparsers.add_parser("compact", help="Move PNG screenshots into chunks")
+    compact.add_argument("--limit", type=int, default=256, help="Screenshots per chunk")
+
+    args = parser.parse_args()
+    archive = FrameArchive(args.directory)
+    if args.command == "export":
+        frames = Compositor(args.outline).composite(archive.between(args.start, args.end))
+        extension = os.path.splitext(args.output)[1].lstrip(".")
+        profile = PRESETS.get(args.preset or extension, PRESETS["h264"])
+        count = write_video(frames, args.output, fps=args.fps, profile=profile)
+        print(f"Exported {count} frames to {args.output}")
+    elif args.command == "compact":
+        freed = 0
+        while any(name.endswith(".png") for _, name, _ in archive.index.records()):
+            freed += archive.compact(args.limit)
+        print(f"Freed {freed} bytes")
+    else:
+        print(f"Freed {archive.rotate(args.keep)} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+    Plays every possible button ahead of time while the poll is open
+"""
+
+import atexit
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+
+import numpy as np
+
+from gb import EMULATOR_PROFILES, MIN_VIDEO_FRAMES, GameBoy
+
+
+game_boy = None  # pylint: disable=invalid-name  # The emulator of each worker process
+
+
+@dataclass
+class Branch:
+    """The outcome of pressing one button from the current state"""
+
+    button: str
+    frames: int
+    state: bytes
+    screen: np.ndarray
+    video: str
+
+
+def start_worker(rom, capture_stride, data_dir, video_profile, encode_slots, profile):
+    """Loads the rom once in each worker process"""
+    global game_boy  # pylint: disable=global-statement
+    game_boy = GameBoy(
+        rom,
+        capture_stride=capture_stride,
+        data_dir=data_dir,
+        encode_slots=encode_slots,
+        video_profile=video_profile,
+        profile=profile,
+    )
+    # Left to the interpreter's teardown, PyBoy fails to clean up and prints
+    # "Error in sys.excepthook" as each worker exits
+    atexit.register(game_boy.pyboy.stop, False)
+
+
+def play_branch(button, action, state, gif_outline, build_video):
+    """Presses a button from a save state in a worker and lets the game settle"""
+    game_boy.pyboy.load_state(io.BytesIO(state))
+    game_boy.frames.clear()
+    game_boy.capture = build_video
+    getattr(game_boy, action)()
+    frames = game_boy.loop_until_stopped()
+
+    screen = game_boy.screen.screen_ndarray().copy()
+
+    video = False
+    if build_video and frames >= MIN_VIDEO_FRAMES:
+        video = game_boy.build_gif(output_name=os.path.join("lookahead", f"{action}.mp4"),
+            gif_outline=gif_outline
+        )
+    game_boy.frames.clear()
+
+    result = io.BytesIO()
+    game_boy.pyboy.save_state(result)
+    return Branch(button, frames, result.getvalue(), screen, video)
+
+
+class Lookahead:
+    """Speculatively plays each button in a pool of worker processes
+
+    Args:
+        rom (str): Path to the rom, each worker loads its own copy
+        buttons (dict): Poll option titles mapped to the GameBoy method that presses them
+        workers (int, optional): Number of worker processes. Defaults to one per button
+        capture_stride (int, optional): Passed on to each worker's GameBoy
+        data_dir (str, optional): The data directory of the bot, videos go in its lookahead folder
+        video_profile (EncodingProfile, optional): How the workers encode videos
+        encode_slots (Semaphore, optional): Limits how many videos are encoded at once, shared
+            with the workers. Must come from the spawn context
+        profile (EmulatorProfile, optional): How the bot's PyBoy is set up. The workers
+            emulate the game the same way, but without a window, sound or speed limit
+    """
+
+    def __init__(self, rom, buttons, workers=None, capture_stride=1, data_dir=".",
+                 video_profile=None, encode_slots=None, profile=None):
+        self.buttons = buttons
+        self.branches = {}
+        os.makedirs(os.path.join(data_dir, "lookahead"), exist_ok=True)
+        profile = replace(
+            profile or EMULATOR_PROFILES["headless"],
+            window_type="headless",
+            sound=False,
+            emulation_speed=0,
+        )
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers or min(len(buttons), os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=start_worker,
+            initargs=(rom, capture_stride, data_dir, video_profile, encode_slots, profile),
+        )
+
+    def start(self, state, gif_outline="gameboy.png", build_video=False):
+        """Starts playing every button from a save state, replacing any previous branches"""
+        self.cancel()
+        self.branches = {
+            button: self.executor.submit(
+                play_branch, button, action, state, gif_outline, build_video
+            )
+            for button, action in self.buttons.items()
+        }
+
+    def cancel(self):
+        """Drops every branch, cancelling those that have not started"""
+        for future in self.branches.values():
+            future.cancel()
+        self.branches = {}
+
+    def commit(self, button, target):
+        """Moves a GameBoy to the outcome of a button, returns None if it was not played ahead
+
+        Args:
+            button (str): The poll option that won
+            target (GameBoy): The GameBoy that continues from the branch
+        """
+        future = self.branches.get(button)
+        if future is None or future.cancelled():
+            return None
+        try:
+            branch = future.result()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            print(f"Lookahead for {button} failed: {e}")
+            return None
+        finally:
+            self.cancel()
+
+        target.pyboy.load_state(io.BytesIO(branch.state))
+        target.discard_frames()
+        return branch
+
+    def shutdown(self):
+        """Stops the worker processes, once the branches already playing are done
+
+        Workers left running when the interpreter exits are killed halfway
+        through a branch, so the ones that started are waited for.
+        """
+        self.cancel()
+        self.executor.shutdown(wait=True, cancel_futures=True)
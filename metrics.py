@@ -0,0 +1,118 @@
+"""
+    Timers and counters for every stage of a turn, logged as JSON and served to Prometheus
+"""
+
+import json
+import logging
+import logging.handlers
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger("metrics")
+
+
+class Metrics:
+    """A registry of timings and counters
+
+    Every measurement is written to the metrics logger as a JSON line, and
+    kept as running totals that can be rendered in the Prometheus text format.
+
+    Args:
+        prefix (str, optional): Prefix of the Prometheus metric names. Defaults to gameboy
+    """
+
+    def __init__(self, prefix="gameboy"):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.timings = {}  # (name, labels) -> [count, total seconds, max seconds]
+        self.counters = {}  # (name, labels) -> value
+
+    def observe(self, name, seconds, **labels):
+        """Records how long something took"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timing = self.timings.setdefault(key, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({"metric": name, "seconds": round(seconds, 6), **labels}))
+
+    def count(self, name, value=1, **labels):
+        """Adds to a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Times the body of a with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        """Returns every metric in the Prometheus text format"""
+        def series(name, labels, value):
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+            if label_text:
+                label_text = f"{{{label_text}}}"
+            return f"{self.prefix}_{name}{label_text} {value}"
+
+        lines = []
+        with self.lock:
+            for (name, labels), (count, total, maximum) in sorted(self.timings.items()):
+                lines.append(series(f"{name}_seconds_count", labels, count))
+                lines.append(series(f"{name}_seconds_sum", labels, total))
+                lines.append(series(f"{name}_seconds_max", labels, maximum))
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(series(f"{name}_total", labels, value))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serves the metrics over HTTP on a background thread, returns the server"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Answers every GET with the current metrics"""
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                """Sends the metrics"""
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                """Keeps scrapes out of the console"""
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True, name="metrics").start()
+        return server
+
+
+def log_to_file(path, max_mb=10, backups=3):
+    """Writes the JSON metrics log to a file, rotated once it reaches max_mb
+
+    Args:
+        path (str): Path of the log
+        max_mb (float, optional): Size the log is rotated at. Defaults to 10
+        backups (int, optional): Rotated logs kept, as path.1 to path.backups. Defaults to 3
+    """
+    handler = logging.handlers.RotatingFileHandler(
+        path, maxBytes=int(max_mb * 1024 * 1024), backupCount=backups, encoding="utf-8"
+    )
+    handler.setFormatter(logging.Formatter('{"time": "%(asctime)s", "event": %(message)s}'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+metrics = Metrics()
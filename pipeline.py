@@ -0,0 +1,81 @@
+"""
+    Runs the stages of a turn concurrently, as soon as the stages they need are done
+"""
+
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from metrics import metrics
+
+
+class Pipeline:
+    """A set of named stages run on worker threads
+
+    Each stage is called with the results of the stages it depends on, which
+    are handed over once they finish. Stages without a dependency between them
+    run at the same time.
+
+    Args:
+        workers (int, optional): Number of stages that can run at once. Defaults to 6
+    """
+
+    def __init__(self, workers=6):
+        self.workers = workers
+        self.stages = {}
+        self.results = {}
+        self.timings = {}
+
+    def stage(self, name, func, after=()):
+        """Adds a stage, func is called with the results of the stages named in after"""
+        self.stages[name] = (func, tuple(after))
+
+    def run_stage(self, name):
+        """Runs a single stage and records when it started and finished"""
+        func, after = self.stages[name]
+        start = time.perf_counter()
+        result = func(*(self.results[dependency] for dependency in after))
+        self.timings[name] = (start, time.perf_counter())
+        metrics.observe("stage", self.timings[name][1] - start, stage=name)
+        return result
+
+    def run(self):
+        """Runs every stage, returns a dict of their results
+
+        Raises the first exception raised by a stage, after the running stages finish.
+        """
+        start = time.perf_counter()
+        pending = dict(self.stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="stage") as executor:
+            while pending or running:
+                for name, (_, after) in list(pending.items()):
+                    if all(dependency in self.results for dependency in after):
+                        running[executor.submit(self.run_stage, name)] = name
+                        del pending[name]
+                if not running:
+                    raise ValueError(f"Stages can never run: {', '.join(pending)}")
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.results[running.pop(future)] = future.result()
+        metrics.observe("turn", time.perf_counter() - start)
+        self.report(start)
+        return self.results
+
+    def critical_path(self):
+        """Returns the chain of stages that finished last, which decided the total time"""
+        path = []
+        name = max(self.timings, key=lambda stage: self.timings[stage][1], default=None)
+        while name is not None:
+            path.append(name)
+            after = self.stages[name][1]
+            name = max(after, key=lambda stage: self.timings[stage][1], default=None)
+        return path[::-1]
+
+    def report(self, start):
+        """Prints how long each stage took and the critical path"""
+        for name, (stage_start, stage_end) in sorted(self.timings.items(), key=lambda x: x[1]):
+            print(
+                f"Stage {name}: {stage_end - stage_start:.2f}s "
+                f"(started at {stage_start - start:.2f}s)"
+            )
+        print(f"Critical path: {' -> '.join(self.critical_path())}")
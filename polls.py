@@ -0,0 +1,73 @@
+"""
+    Follows a Mastodon poll's votes until it closes
+"""
+
+import time
+from datetime import datetime, timezone
+
+
+class PollWatcher:
+    """Keeps a cached copy of a poll, refreshing it more often as it gets close to closing
+
+    Only the poll itself is refetched, which is much lighter than the status
+    it belongs to. Refreshes slow down when the server's rate limit is low.
+
+    Args:
+        mastodon (Mastodon): The logged in Mastodon client
+        poll_status (dict): The status the poll belongs to
+        min_interval (float, optional): Shortest time between refreshes. Defaults to 5
+        max_interval (float, optional): Longest time between refreshes. Defaults to 600
+        reserve (int, optional): Requests left in the rate limit before backing off. Defaults to 30
+    """
+
+    def __init__(self, mastodon, poll_status, min_interval=5, max_interval=600, reserve=30):
+        self.mastodon = mastodon
+        self.poll = poll_status["poll"]
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.reserve = reserve
+        self.requests = 0
+
+    def refresh(self):
+        """Fetches the latest votes, keeping the cached poll if the request fails"""
+        try:
+            self.poll = self.mastodon.poll(self.poll["id"])
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            print(f"Failure to refresh poll: {e}")
+        self.requests += 1
+        return self.poll
+
+    def seconds_left(self):
+        """Returns how long until the poll closes"""
+        if self.poll.get("expired"):
+            return 0
+        return max((self.poll["expires_at"] - datetime.now(timezone.utc)).total_seconds(), 0)
+
+    def next_interval(self):
+        """Returns how long to wait before the next refresh"""
+        left = self.seconds_left()
+        interval = max(min(left / 2, self.max_interval), self.min_interval)
+        if left:
+            interval = min(interval, left)
+        remaining = getattr(self.mastodon, "ratelimit_remaining", None)
+        if remaining is not None and remaining < self.reserve:
+            reset = getattr(self.mastodon, "ratelimit_reset", time.time())
+            interval = max(interval, reset - time.time())
+        return interval
+
+    def wait(self, grace=5, on_refresh=None):
+        """Waits until the poll closes, returns its final options and vote counts
+
+        Args:
+            grace (float, optional): Seconds to wait after it closes for late votes. Defaults to 5
+            on_refresh (callable, optional): Called after each refresh, to follow other votes
+        """
+        while self.seconds_left():
+            votes = sum(option["votes_count"] or 0 for option in self.poll["options"])
+            print(f"Poll closes in {self.seconds_left():.0f}s, {votes} votes so far")
+            time.sleep(self.next_interval())
+            self.refresh()
+            if on_refresh:
+                on_refresh()
+        time.sleep(grace)
+        return self.refresh()["options"]
@@ -0,0 +1,159 @@
+"""
+    Keeps the data directory within a size and age budget
+"""
+
+import os
+import shutil
+import time
+
+from metrics import metrics
+
+
+VIDEO_EXTENSIONS = (".mp4", ".gif", ".webp")
+
+
+def directory_size(directory):
+    """Returns the total size of the files under a directory"""
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory)
+        for name in names
+    )
+
+
+class RetentionManager:
+    """Deletes what the bot no longer needs, so the data directory stops growing
+
+    At startup, whatever interrupted turns left behind is removed. After each
+    turn, a batch of PNG screenshots from older versions is compacted into the
+    archive, and the oldest archive chunks are deleted once the archive is over
+    its size or age budget. Timelapse segments past the age budget go too.
+    Every byte freed is counted in the reclaimed_bytes metric.
+
+    Args:
+        data_dir (str): The bot's data directory
+        archive (FrameArchive): The screenshot archive
+        max_mb (float, optional): Size budget of the archive. Defaults to no limit
+        max_age_days (float, optional): Chunks not written to for longer are deleted.
+            Defaults to no limit
+        compact_batch (int, optional): PNG screenshots compacted per turn, 0 to keep them.
+            Defaults to 256
+        timelapse (Timelapse, optional): The timelapse whose segments are kept in the budget
+    """
+
+    # Written by older versions or by workers of a previous run, never read again
+    ORPHAN_DIRECTORIES = ("gif_images", "tmp", "lookahead")
+    # Videos rebuilt every turn, a leftover one is from a turn that never finished
+    TURN_VIDEOS = ("action", "test")
+
+    def __init__(self, data_dir, archive, max_mb=None, max_age_days=None, compact_batch=256,
+                 timelapse=None):
+        self.data_dir = data_dir
+        self.archive = archive
+        self.timelapse = timelapse
+        self.max_bytes = max_mb * 1024 * 1024 if max_mb else None
+        self.max_age = max_age_days * 24 * 60 * 60 if max_age_days else None
+        self.compact_batch = compact_batch
+        self.reclaimed = 0
+
+    def clean_orphans(self):
+        """Removes what interrupted turns left behind, returns the number of bytes freed
+
+        Only safe before the bot starts playing, the files may still be in use otherwise.
+        """
+        freed = 0
+        for name in self.ORPHAN_DIRECTORIES:
+            path = os.path.join(self.data_dir, name)
+            if os.path.isdir(path):
+                freed += directory_size(path)
+                shutil.rmtree(path, ignore_errors=True)
+
+        # Half written indexes, chunks and checkpoints
+        directories = (self.data_dir, self.archive.directory, os.path.join(self.data_dir, "states"))
+        for directory in directories:
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                base, extension = os.path.splitext(name)
+                orphan = extension == ".tmp" or (
+                    directory == self.data_dir
+                    and base in self.TURN_VIDEOS
+                    and extension in VIDEO_EXTENSIONS
+                )
+                path = os.path.join(directory, name)
+                if orphan and os.path.isfile(path):
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+
+        if self.timelapse is not None:
+            for path in self.timelapse.orphans():
+                freed += os.path.getsize(path)
+                os.remove(path)
+        self.report(freed)
+        return freed
+
+    def enforce_budget(self):
+        """Deletes the oldest archive chunks until the archive fits its budget
+
+        Returns:
+            int: The number of bytes freed
+        """
+        if self.max_bytes is None and self.max_age is None:
+            return 0
+        paths = [os.path.join(self.archive.directory, chunk) for chunk in self.archive.chunks()]
+        stats = [os.stat(path) for path in paths]
+        total = sum(stat.st_size for stat in stats)
+        cutoff = time.time() - self.max_age if self.max_age is not None else None
+        expired = 0
+        for stat in stats:
+            over_size = self.max_bytes is not None and total > self.max_bytes
+            over_age = cutoff is not None and stat.st_mtime < cutoff
+            if not (over_size or over_age):
+                break
+            total -= stat.st_size
+            expired += 1
+        if not expired:
+            return 0
+        # rotate() never deletes the chunk being written to
+        return self.archive.rotate(len(paths) - expired)
+
+    def expire_segments(self):
+        """Deletes the timelapse segments older than the age budget
+
+        The index keeps listing them, the timelapse skips segments that are gone.
+
+        Returns:
+            int: The number of bytes freed
+        """
+        if self.timelapse is None or self.max_age is None:
+            return 0
+        cutoff = time.time() - self.max_age
+        freed = 0
+        for first, _, encoded, _ in self.timelapse.records():
+            if encoded >= cutoff:
+                break
+            path = self.timelapse.path(first)
+            if os.path.exists(path):
+                freed += os.path.getsize(path)
+                os.remove(path)
+        return freed
+
+    def collect(self):
+        """Compacts a batch of PNG screenshots and enforces the budget, run after each turn
+
+        Returns:
+            int: The number of bytes freed
+        """
+        with metrics.timer("retention"):
+            freed = self.archive.compact(self.compact_batch) if self.compact_batch else 0
+            freed += self.enforce_budget()
+            freed += self.expire_segments()
+        self.report(freed)
+        return freed
+
+    def report(self, freed):
+        """Counts the bytes freed by a pass"""
+        self.reclaimed += freed
+        metrics.count("reclaimed_bytes", freed)
+        if freed:
+            print(f"Reclaimed {freed} bytes, {self.reclaimed} since starting")
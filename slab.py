@@ -0,0 +1,247 @@
+"""
+    Hands frames from the emulator to an encoder process through shared memory
+"""
+
+import atexit
+import math
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from frames import SCREEN_SHAPE
+from metrics import metrics
+from video import Compositor, composite_runs, write_video
+
+
+FRAME_BYTES = int(np.prod(SCREEN_SHAPE))
+HEAD, TAIL, CLOSED, SLOTS = range(4)  # Fields of the header
+
+
+class FrameSlab:
+    """A ring of frame slots in shared memory, written by one process and read by another
+
+    The producer only moves the head and the consumer only moves the tail, so
+    neither needs a lock: a slot is written before the head moves past it, and
+    only reused after the tail has. Like FrameBuffer, a frame identical to the
+    one before it lengthens the run of the last slot, which is kept back from
+    the consumer until the next different frame arrives.
+
+    If the consumer process exits while the producer waits for a free slot,
+    the remaining frames are dropped instead, as nothing would take them.
+
+    Args:
+        slots (int, optional): Number of frames the slab holds. Defaults to 128
+        name (str, optional): Attaches to an existing slab instead of creating one
+    """
+
+    def __init__(self, slots=128, name=None):
+        if name is None:
+            size = 8 * 4 + 8 * slots + FRAME_BYTES * slots
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        buffer = self.memory.buf
+        self.header = np.ndarray(4, dtype=np.uint64, buffer=buffer)
+        if self.owner:
+            self.header[:] = (0, 0, 0, slots)
+        slots = int(self.header[SLOTS])
+        self.slots = slots
+        self.runs = np.ndarray(slots, dtype=np.int64, buffer=buffer, offset=8 * 4)
+        self.frames = np.ndarray(
+            (slots, *SCREEN_SHAPE), dtype=np.uint8, buffer=buffer, offset=8 * 4 + 8 * slots
+        )
+        self.staged = False  # Whether the producer holds back a slot at the head
+        self.consumer = None  # The process reading the slab, checked while waiting for it
+        self.dropping = False  # Whether the consumer exited and frames are being dropped
+
+    @property
+    def name(self):
+        """The name other processes attach with"""
+        return self.memory.name
+
+    def latest(self):
+        """Returns the frame being held back by the producer, or None"""
+        if not self.staged:
+            return None
+        return self.frames[int(self.header[HEAD]) % self.slots]
+
+    def append(self, frame, timeout=60):
+        """Copies a frame into the next free slot, waiting for the consumer if the slab is full
+
+        Args:
+            frame (np.ndarray): The frame to copy
+            timeout (float, optional): Gives up after waiting this many seconds for a free slot
+        """
+        if self.dropping:
+            return
+        self.flush()
+        head = int(self.header[HEAD])
+        deadline = time.monotonic() + timeout
+        while head - int(self.header[TAIL]) >= self.slots:
+            if self.consumer is not None and not self.consumer.is_alive():
+                print("The encoder process exited, dropping the frames of this video")
+                metrics.count("encoder_failures")
+                self.dropping = True
+                return
+            if time.monotonic() > deadline:
+                raise TimeoutError("The consumer stopped taking frames")
+            time.sleep(0.0005)
+        index = head % self.slots
+        np.copyto(self.frames[index], frame[:, :, :3])
+        self.runs[index] = 1
+        self.staged = True
+
+    def extend_run(self, run=1):
+        """Counts the frame being held back as captured again"""
+        if self.staged:
+            self.runs[int(self.header[HEAD]) % self.slots] += run
+
+    def flush(self):
+        """Hands the frame being held back to the consumer"""
+        if self.staged:
+            self.header[HEAD] += 1
+            self.staged = False
+
+    def close(self):
+        """Hands over the last frame and tells the consumer no more are coming"""
+        if self.staged:
+            # A negative run marks the last frame, it is written before the head moves
+            index = int(self.header[HEAD]) % self.slots
+            self.runs[index] = -self.runs[index]
+        self.flush()
+        self.header[CLOSED] = 1
+
+    def consume(self, timeout=None):
+        """Yields (frame, run, last) for each frame until the producer closes the slab
+
+        The frames are views of the slots, each slot is given back to the
+        producer when the next frame is requested.
+
+        Args:
+            timeout (float, optional): Gives up after this many seconds without a new frame
+        """
+        deadline = None
+        idle = 0.001
+        while True:
+            tail = int(self.header[TAIL])
+            if tail < int(self.header[HEAD]):
+                index = tail % self.slots
+                run = int(self.runs[index])
+                yield self.frames[index], abs(run), run < 0
+                self.header[TAIL] = tail + 1
+                deadline = None
+                idle = 0.001
+            elif self.header[CLOSED]:
+                # close() moves the head before it sets CLOSED, so a frame published
+                # after the head was read above is still waiting
+                if int(self.header[TAIL]) >= int(self.header[HEAD]):
+                    return
+            else:
+                parent = multiprocessing.parent_process()
+                if parent is not None and not parent.is_alive():
+                    raise RuntimeError("The emulator process exited without closing the slab")
+                if timeout is not None:
+                    deadline = deadline or time.monotonic() + timeout
+                    if time.monotonic() > deadline:
+                        raise TimeoutError("No frame was published in time")
+                # Backs off while the game is idle, between turns the encoder waits for an hour
+                time.sleep(idle)
+                idle = min(idle * 2, 0.05)
+
+    def release(self):
+        """Detaches from the shared memory, and frees it if this process created it"""
+        self.header = self.runs = self.frames = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def encode_slab(name, save_path, fps, profile, gif_outline, hold=0):
+    """Encodes the frames of a slab as they arrive, the target of the encoder process
+
+    Each run is composited once and cut to the profile's max_still. The
+    length of the last run is only known once it arrives, after ffmpeg has
+    started, so it is shown once and held for hold seconds instead.
+
+    Returns:
+        int: The number of frames written
+    """
+    slab = FrameSlab(name=name)
+    longest = max(int(profile.max_still * fps), 1) if profile.max_still else None
+    step = math.ceil(fps / profile.max_fps) if profile.max_fps else 1
+
+    def runs():
+        position = 0
+        for frame, run, last in slab.consume():
+            run = min(run, longest) if longest else run
+            # Keeps the frames at multiples of step, like resample_runs
+            shown = (position + run + step - 1) // step - (position + step - 1) // step
+            position += run
+            if last and hold:
+                shown = 1
+            if shown:
+                yield frame, shown
+
+    try:
+        video = composite_runs(Compositor(gif_outline), runs())
+        return write_video(
+            video, save_path, fps=fps / step, profile=profile, drop_duplicates=True, hold=hold
+        )
+    finally:
+        slab.release()
+
+
+class SlabEncoder:
+    """Encodes a video in its own process from the frames published to a slab
+
+    Args:
+        save_path (str): Where the video is written
+        fps (float): Frames per second of the video
+        profile (EncodingProfile): How the video is encoded
+        gif_outline (str): Path to the Game Boy outline image
+        slots (int, optional): Number of frames the slab holds. Defaults to 256
+    """
+
+    def __init__(self, save_path, fps, profile, gif_outline, slots=256):
+        self.save_path = save_path
+        self.slab = FrameSlab(slots)
+        hold = max(profile.max_still - 1 / fps, 0) if profile.max_still else 0
+        context = multiprocessing.get_context("spawn")
+        self.results = context.SimpleQueue()
+        self.process = context.Process(
+            target=run_encoder,
+            args=(self.results, self.slab.name, save_path, fps, profile, gif_outline, hold),
+            name="encoder",
+            daemon=True,
+        )
+        self.process.start()
+        self.slab.consumer = self.process
+        # An encoder started ahead of a turn that never comes still frees its memory
+        atexit.register(self.finish)
+
+    def finish(self):
+        """Waits for the video, returns its path or False if no frames were published"""
+        atexit.unregister(self.finish)
+        self.slab.close()
+        with metrics.timer("encoder_wait"):
+            self.process.join()
+        count = 0 if self.results.empty() else self.results.get()
+        self.slab.release()
+        return self.save_path if count else False
+
+
+def run_encoder(results, name, save_path, fps, profile, gif_outline, hold):
+    """Runs encode_slab and sends back the number of frames written, 0 if it failed"""
+    try:
+        count = encode_slab(name, save_path, fps, profile, gif_outline, hold)
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        print(f"Encoder failed: {e}")
+        count = 0
+    if not count and os.path.exists(save_path):
+        os.remove(save_path)
+    results.put(count)
@@ -0,0 +1,113 @@
+"""
+    Keeps a history of Game Boy save states in memory and on disk
+"""
+
+import io
+import os
+import re
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+
+class SnapshotStore:
+    """A rolling history of save states, keyed by turn number
+
+    Snapshots are kept in memory so restoring a recent turn never touches the
+    disk. Every snapshot is also compressed and written to a checkpoint file on
+    a background thread, replacing the file atomically so a crash never leaves
+    a half written state.
+
+    Args:
+        directory (str): Where checkpoint files are written
+        history (int, optional): Number of snapshots kept in memory. Defaults to 24
+        keep (int, optional): Number of checkpoints kept on disk. Defaults to 168
+    """
+
+    PATTERN = re.compile(r"turn_(\d+)\.state\.z")
+
+    def __init__(self, directory, history=24, keep=168):
+        self.directory = directory
+        self.history = history
+        self.keep = keep
+        self.snapshots = OrderedDict()
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self.pending = []
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, turn):
+        """Returns the checkpoint path of a turn"""
+        return os.path.join(self.directory, f"turn_{turn:08d}.state.z")
+
+    def checkpoints(self):
+        """Returns the turn numbers that have a checkpoint on disk, oldest first"""
+        return sorted(
+            int(match.group(1))
+            for match in map(self.PATTERN.fullmatch, os.listdir(self.directory))
+            if match
+        )
+
+    def latest_turn(self):
+        """Returns the newest turn in memory or on disk, 0 if there are none"""
+        turns = list(self.snapshots) + self.checkpoints()[-1:]
+        return max(turns, default=0)
+
+    def take(self, pyboy, turn=None):
+        """Snapshots the emulator and checkpoints it in the background
+
+        Args:
+            pyboy (PyBoy): The emulator to snapshot
+            turn (int, optional): The turn number. Defaults to the turn after the latest one
+
+        Returns:
+            int: The turn number of the snapshot
+        """
+        if turn is None:
+            turn = self.latest_turn() + 1
+        state = io.BytesIO()
+        pyboy.save_state(state)
+        self.snapshots[turn] = state.getvalue()
+        self.snapshots.move_to_end(turn)
+        while len(self.snapshots) > self.history:
+            self.snapshots.popitem(last=False)
+        self.pending.append(self.writer.submit(self.write_checkpoint, turn, self.snapshots[turn]))
+        return turn
+
+    def write_checkpoint(self, turn, state):
+        """Compresses a state to its checkpoint file and removes the oldest checkpoints"""
+        path = self.path(turn)
+        temp_path = f"{path}.tmp"
+        with metrics.timer("checkpoint"):
+            with open(temp_path, "wb") as file:
+                file.write(zlib.compress(state))
+            os.replace(temp_path, path)
+
+        for old_turn in self.checkpoints()[:-self.keep]:
+            os.remove(self.path(old_turn))
+
+    def get(self, turn=None):
+        """Returns the state of a turn (the latest by default), or None if there is none"""
+        if turn is None:
+            turn = self.latest_turn()
+        if turn in self.snapshots:
+            return self.snapshots[turn]
+        if os.path.exists(self.path(turn)):
+            with open(self.path(turn), "rb") as file:
+                return zlib.decompress(file.read())
+        return None
+
+    def restore(self, pyboy, turn=None):
+        """Loads the state of a turn (the latest by default), returns False if there is none"""
+        state = self.get(turn)
+        if state is None:
+            return False
+        pyboy.load_state(io.BytesIO(state))
+        return True
+
+    def flush(self):
+        """Waits for every pending checkpoint to be written, raising any error writing them"""
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
@@ -0,0 +1,94 @@
+"""
+    Runs several bots (one per game and account) side by side, each in its own process
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import time
+
+import toml
+
+from bot import Bot
+
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+def run_instance(config, encode_slots, poll_offset):
+    """Runs one bot in daemon mode, the target of each worker process"""
+    bot = Bot(config=config, encode_slots=encode_slots)
+    bot.serve(poll_offset)
+
+
+class Supervisor:
+    """Starts a daemon bot per [[instances]] entry of the config and restarts any that exit
+
+    Every instance needs its own data_dir. Video encodes are limited across all
+    instances by a shared semaphore, and each instance's polls close a stagger
+    after the previous instance's, so their turns, and their encodes, don't all
+    land at the same time. The offsets are kept across restarts.
+
+    Args:
+        config_path (str, optional): Path to the config file. Defaults to config.toml
+    """
+
+    def __init__(self, config_path="config.toml"):
+        config_path = os.path.join(script_dir, config_path)
+        with open(config_path, "r", encoding="utf-8") as config_file:
+            config = toml.load(config_file)
+        self.instances = config.get("instances", [])
+        supervisor_config = config.get("supervisor", {})
+        self.stagger = supervisor_config.get("stagger", 60)
+        self.restart_delay = supervisor_config.get("restart_delay", 60)
+        # Spawned, so the semaphore can be passed on to the lookahead workers, which are too
+        self.context = multiprocessing.get_context("spawn")
+        self.encode_slots = self.context.BoundedSemaphore(
+            supervisor_config.get("encode_workers", max((os.cpu_count() or 2) // 2, 1))
+        )
+        self.processes = {}
+
+        data_dirs = [instance.get("data_dir") for instance in self.instances]
+        if None in data_dirs or len(set(data_dirs)) != len(data_dirs):
+            raise ValueError("Every instance needs its own data_dir")
+
+    def start(self, index):
+        """Starts the process of an instance"""
+        instance = self.instances[index]
+        process = self.context.Process(
+            target=run_instance,
+            args=(instance, self.encode_slots, index * self.stagger),
+            name=instance.get("name", instance["data_dir"]),
+        )
+        process.start()
+        self.processes[index] = process
+        print(f"Started {process.name} (pid {process.pid})")
+
+    def run(self):
+        """Starts every instance and keeps them running"""
+        for index in range(len(self.instances)):
+            self.start(index)
+        try:
+            while True:
+                time.sleep(self.restart_delay)
+                for index, process in self.processes.items():
+                    if not process.is_alive():
+                        print(f"{process.name} exited with {process.exitcode}, restarting")
+                        self.start(index)
+        finally:
+            # Interrupt the bots so they save their game before exiting
+            for process in self.processes.values():
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGINT)
+            for process in self.processes.values():
+                process.join(timeout=60)
+                if process.is_alive():
+                    process.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("config", nargs="?", default="config.toml")
+    arguments = parser.parse_args()
+    Supervisor(arguments.config).run()
@@ -0,0 +1,47 @@
+"""
+    Tests reading button commands from replies, as Mastodon renders them
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from votes import VoteCollector  # pylint: disable=wrong-import-position
+
+
+BUTTONS = {
+    "Up ⬆️": "dpad_up",
+    "Down ⬇️": "dpad_down",
+    "Left ⬅️": "dpad_left",
+    "🅰": "a",
+    "Start": "start",
+}
+
+
+def mention(name="pokemon", server="https://tomkahe.com"):
+    """Returns a mention the way Mastodon renders it in a status' content"""
+    return (
+        f'<span class="h-card" translate="no"><a href="{server}/@{name}" '
+        f'class="u-url mention">@<span>{name}</span></a></span>'
+    )
+
+
+@pytest.mark.parametrize("content, button", [
+    (f"<p>{mention()} up</p>", "Up ⬆️"),
+    (f"<p>{mention()} Up ⬆️</p>", "Up ⬆️"),
+    (f"<p>{mention()} {mention('friend', 'https://example.social')} left!</p>", "Left ⬅️"),
+    (f"<p>{mention()} 🅰 please</p>", "🅰"),
+    (f"<p>{mention()} start</p><p>let's go</p>", "Start"),
+    (f'<p>{mention()} a <a href="https://tomkahe.com/tags/pokemon" class="mention hashtag" '
+     'rel="tag">#<span>pokemon</span></a></p>', "🅰"),
+    ("<p>@pokemon down</p>", "Down ⬇️"),
+    (f"<p>{mention()} what a great move lol</p>", None),
+    (f"<p>{mention()} I left my game at home, start over?</p>", None),
+    (f"<p>{mention()}</p>", None),
+])
+def test_parse(content, button):
+    """Commands are read from real status HTML, conversation is not a vote"""
+    assert VoteCollector(None, BUTTONS).parse(content) == button
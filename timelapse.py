@@ -0,0 +1,264 @@
+"""
+    Builds a timelapse of the whole game from segments encoded once per turn
+"""
+
+import argparse
+import os
+import struct
+import subprocess
+import tempfile
+import time
+from dataclasses import replace
+from datetime import date, datetime, timedelta, timezone
+
+from history import FrameArchive
+from metrics import metrics
+from video import PRESETS, Compositor, write_video
+
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+class Timelapse:
+    """A video of every screenshot, joined from short segments without re-encoding
+
+    Once segment_frames screenshots have been taken since the last segment,
+    they are encoded into a new one, so no turn costs more than one segment. A
+    video of any stretch of the game is then made by stream-copying the
+    segments one after the other, which takes seconds even for months of play.
+    The screenshots not in a segment yet are encoded on the fly.
+
+    Segments are listed in an append-only index of fixed-size records, like
+    the screenshot index. A segment spans from when the one before it was
+    encoded to when it was, those made while catching up on older screenshots
+    are dated when they are encoded.
+
+    Args:
+        directory (str): Where the segments and their index are kept
+        archive (FrameArchive): The screenshot archive the frames are read from
+        compositor (Compositor): Places the screenshots onto the Game Boy outline
+        fps (float, optional): Screenshots per second of the timelapse. Defaults to 5
+        profile (EncodingProfile, optional): How segments are encoded, only mp4 can be joined
+            without re-encoding. Defaults to the h264 preset
+        segment_frames (int, optional): Most screenshots in one segment. Defaults to 256
+    """
+
+    RECORD = struct.Struct("<QQdI")  # first and last screenshot number, time, frames
+
+    def __init__(self, directory, archive, compositor, fps=5, profile=None, segment_frames=256):
+        profile = profile or PRESETS["h264"]
+        if profile.format != "mp4":
+            raise ValueError(f"Timelapse segments can't be {profile.format}, only mp4")
+        # Every screenshot is kept, and a segment is far below any upload limit
+        self.profile = replace(profile, max_fps=None, max_still=None, max_size_mb=None)
+        self.directory = directory
+        self.archive = archive
+        self.compositor = compositor
+        self.fps = fps
+        self.segment_frames = segment_frames
+        self.index_path = os.path.join(directory, "segments.bin")
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, first):
+        """Returns the path of the segment starting at a screenshot number"""
+        return os.path.join(self.directory, f"segment_{first:08d}.mp4")
+
+    def records(self):
+        """Returns every (first, last, time, frames) record in the index, oldest first"""
+        if not os.path.exists(self.index_path):
+            return []
+        with open(self.index_path, "rb") as file:
+            data = file.read()
+        size = self.RECORD.size
+        return [self.RECORD.unpack(data[i:i + size]) for i in range(0, len(data) - size + 1, size)]
+
+    def last_number(self):
+        """Returns the last screenshot number in a segment, 0 if there are none"""
+        if not os.path.exists(self.index_path):
+            return 0
+        with open(self.index_path, "rb") as file:
+            file.seek(0, os.SEEK_END)
+            if file.tell() < self.RECORD.size:
+                return 0
+            file.seek(file.tell() - file.tell() % self.RECORD.size - self.RECORD.size)
+            return self.RECORD.unpack(file.read(self.RECORD.size))[1]
+
+    def orphans(self):
+        """Returns the files interrupted encodes and builds left behind"""
+        last = self.last_number()
+        paths = []
+        for name in os.listdir(self.directory):
+            base = os.path.splitext(name)[0]
+            number = base.removeprefix("segment_")
+            # Only indexed segments are joined, one past the index was never finished
+            unindexed = number != base and number.isdigit() and int(number) > last
+            if unindexed or base.startswith(("tail_", "listing_")):
+                paths.append(os.path.join(self.directory, name))
+        return paths
+
+    def update(self, max_segments=None):
+        """Encodes the screenshots taken since the last segment, segment_frames at a time
+
+        Fewer screenshots than that are left for the next update.
+
+        Args:
+            max_segments (int, optional): Most segments encoded at once, limits how long
+                catching up on older screenshots takes per turn. Defaults to no limit
+
+        Returns:
+            int: The number of screenshots encoded
+        """
+        latest = self.archive.index.last_number()
+        start = self.last_number() + 1
+        encoded = 0
+        segments = 0
+        while start + self.segment_frames - 1 <= latest and (
+            max_segments is None or segments < max_segments
+        ):
+            end = start + self.segment_frames - 1
+            encoded += self.encode_segment(start, end)
+            start = end + 1
+            segments += 1
+        return encoded
+
+    def encode_segment(self, first, last):
+        """Encodes the screenshots numbered first to last into a segment, returns their count
+
+        Screenshots deleted from the archive are skipped, the segment is still
+        indexed so they are not looked for again.
+        """
+        # Only indexed segments are joined, one interrupted here is encoded again
+        count = self.write(self.screenshots(first, last), self.path(first))
+        with open(self.index_path, "ab") as file:
+            file.write(self.RECORD.pack(first, last, time.time(), count))
+        metrics.count("timelapse_frames", count)
+        return count
+
+    def screenshots(self, first, last):
+        """Returns the index records of the screenshots numbered first to last"""
+        latest = self.archive.index.last_number()
+        if first > min(last, latest):
+            return []
+        # Reading from the end of the index keeps this independent of the archive's size
+        return [
+            record
+            for record in self.archive.index.tail(latest - first + 1)
+            if first <= record[0] <= last
+        ]
+
+    def write(self, records, path):
+        """Encodes the screenshots of some index records into a video, returns their count"""
+        if not records:
+            return 0
+        with metrics.timer("timelapse_segment"):
+            frames = self.compositor.composite(self.archive.read(records))
+            return write_video(
+                frames, path, fps=self.fps, profile=self.profile, frame_count=len(records)
+            )
+
+    def build(self, output, since=None, until=None):
+        """Joins the segments spanning two times into one video, without re-encoding
+
+        The screenshots not in a segment yet are encoded into one more, which
+        spans from the last segment to now.
+
+        Args:
+            output (str): Path of the video
+            since (float, optional): Unix time of the first segment. Defaults to the beginning
+            until (float, optional): Unix time the segments end before. Defaults to now
+
+        Returns:
+            int: The number of screenshots in the video, 0 if there were none
+        """
+        import imageio_ffmpeg  # pylint: disable=import-outside-toplevel
+
+        def spans(start, end):
+            return (since is None or end >= since) and (until is None or start < until)
+
+        segments = []
+        start = 0
+        for first, _, encoded, frames in self.records():
+            if frames and spans(start, encoded) and os.path.exists(self.path(first)):
+                segments.append((self.path(first), frames))
+            start = encoded
+        pending = self.screenshots(self.last_number() + 1, self.archive.index.last_number())
+        temporary = []
+        try:
+            if pending and spans(start, time.time()):
+                with tempfile.NamedTemporaryFile(
+                    prefix="tail_", suffix=".mp4", dir=self.directory, delete=False
+                ) as tail:
+                    temporary.append(tail.name)
+                frames = self.write(pending, tail.name)
+                if frames:
+                    segments.append((tail.name, frames))
+            if not segments:
+                return 0
+            with tempfile.NamedTemporaryFile(
+                "w", prefix="listing_", suffix=".txt", dir=self.directory, delete=False,
+                encoding="utf-8"
+            ) as listing:
+                temporary.append(listing.name)
+                for path, frames in segments:
+                    # The duration keeps every segment's frames in step however it was muxed
+                    listing.write(f"file '{path}'\nduration {frames / self.fps}\n")
+            with metrics.timer("timelapse_build"):
+                subprocess.run(
+                    [
+                        imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error",
+                        "-f", "concat", "-safe", "0", "-i", listing.name,
+                        "-c", "copy", "-movflags", "+faststart", output,
+                    ],
+                    check=True,
+                )
+        finally:
+            for path in temporary:
+                if os.path.exists(path):
+                    os.remove(path)
+        return sum(frames for _, frames in segments)
+
+
+def day_range(day):
+    """Returns the Unix times a UTC day starts and ends at"""
+    start = datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+    return start.timestamp(), (start + timedelta(days=1)).timestamp()
+
+
+def main():
+    """Command line interface for encoding and joining timelapse segments"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--data-dir", default=script_dir)
+    parser.add_argument("--outline", default=os.path.join(script_dir, "gameboy.png"))
+    parser.add_argument("--fps", type=float, default=5)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("update", help="Encode every full segment not encoded yet")
+
+    build = subparsers.add_parser("build", help="Join segments into a video")
+    build.add_argument("output")
+    span = build.add_mutually_exclusive_group()
+    span.add_argument("--day", type=date.fromisoformat, help="A UTC day, as YYYY-MM-DD")
+    span.add_argument(
+        "--week", type=date.fromisoformat, help="The 7 UTC days starting on YYYY-MM-DD"
+    )
+
+    args = parser.parse_args()
+    archive = FrameArchive(os.path.join(args.data_dir, "screenshots"))
+    timelapse = Timelapse(
+        os.path.join(args.data_dir, "timelapse"), archive, Compositor(args.outline), args.fps
+    )
+    if args.command == "update":
+        print(f"Encoded {timelapse.update()} screenshots")
+        return
+    since = until = None
+    if args.day:
+        since, until = day_range(args.day)
+    elif args.week:
+        since = day_range(args.week)[0]
+        until = day_range(args.week + timedelta(days=6))[1]
+    count = timelapse.build(args.output, since, until)
+    print(f"Joined {count} screenshots into {args.output}" if count else "No segments to join")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""
+    Streams Game Boy frames into a video without writing intermediate images
+"""
+
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, fields, replace
+from itertools import repeat
+
+import numpy as np
+from PIL import Image
+
+from frames import SCREEN_HEIGHT, SCREEN_SHAPE, SCREEN_WIDTH
+from metrics import metrics
+
+
+SCREEN_POSITION = (370, 319)
+SCREEN_SIZE = (822, 733)
+
+
+class Compositor:
+    """Places Game Boy frames onto a Game Boy outline image
+
+    The outline is decoded once. Each call to composite() copies it into a
+    preallocated batch of output frames, and only the screen area is rewritten
+    for each frame, using lookup tables for a nearest neighbour upscale. The
+    same compositor can be used by several threads at once.
+
+    Args:
+        gif_outline (str): Path to the Game Boy outline image
+        batch_size (int, optional): Number of frames composited at once. Defaults to 8
+        position (tuple, optional): Top left corner of the screen on the outline
+        size (tuple, optional): Width and height of the screen on the outline
+    """
+
+    def __init__(self, gif_outline, batch_size=8, position=SCREEN_POSITION, size=SCREEN_SIZE):
+        self.outline = np.asarray(Image.open(gif_outline).convert("RGB"))
+        self.batch_size = batch_size
+        height, width = self.outline.shape[:2]
+
+        # The screen is clipped to the outline, the same way PIL's paste does
+        left, top = position
+        screen_width, screen_height = size
+        self.left, self.top = left, top
+        self.right = min(left + screen_width, width)
+        self.bottom = min(top + screen_height, height)
+        self.rows = (np.arange(self.bottom - top) * SCREEN_HEIGHT) // screen_height
+        self.columns = (np.arange(self.right - left) * SCREEN_WIDTH) // screen_width
+
+    @property
+    def size(self):
+        """The (width, height) of the composited frames"""
+        return self.outline.shape[1], self.outline.shape[0]
+
+    def create_output(self):
+        """Allocates a batch of output frames filled with the outline"""
+        output = np.empty((self.batch_size, *self.outline.shape), dtype=np.uint8)
+        output[:] = self.outline
+        return output
+
+    def composite_batch(self, frames, output):
+        """Composites a stack of up to batch_size frames into an output buffer
+
+        Args:
+            frames (np.ndarray): An (n, 144, 160, 3) array of frames
+            output (np.ndarray): A buffer from create_output()
+
+        Returns:
+            np.ndarray: A view of the output buffer, overwritten by the next batch
+        """
+        count = len(frames)
+        screen = output[:count, self.top:self.bottom, self.left:self.right]
+        screen[:] = frames[:, self.rows[:, None], self.columns, :3]
+        return output[:count]
+
+    def composite(self, frames):
+        """Composites frames in batches, yielding each combined frame
+
+        The yielded arrays are reused, so they must be consumed before the next
+        one is requested.
+
+        Args:
+            frames (iterable): Frames as (144, 160, 3) uint8 arrays
+        """
+        batch = np.empty((self.batch_size, *SCREEN_SHAPE), dtype=np.uint8)
+        output = self.create_output()
+        count = 0
+        for frame in frames:
+            batch[count] = frame[:, :, :3]
+            count += 1
+            if count == self.batch_size:
+                yield from self.timed_batch(batch, output)
+                count = 0
+        if count:
+            yield from self.timed_batch(batch[:count], output)
+
+    def timed_batch(self, frames, output):
+        """Runs composite_batch, adding its time to the compositing metrics"""
+        start = time.perf_counter()
+        composited = self.composite_batch(frames, output)
+        metrics.count("composite_seconds", time.perf_counter() - start)
+        metrics.count("frames_composited", len(frames))
+        return composited
+
+
+@dataclass
+class EncodingProfile:
+    """How videos are encoded for upload
+
+    Args:
+        format (str, optional): mp4 (H.264), gif or webp. Defaults to mp4
+        crf (int, optional): Quality of mp4 videos, lower is better and larger. Defaults to 23
+        speed (str, optional): x264 preset, faster presets make larger files. Defaults to veryfast
+        quality (int, optional): Quality of lossy webp videos, 0 to 100. Defaults to 75
+        lossless (bool, optional): Keep the exact colours, for mp4 and webp videos
+        max_fps (float, optional): Frames are dropped to stay under this rate
+        max_still (float, optional): Seconds a still screen is shown at most, longer idle
+            stretches are cut short
+        max_size_mb (float, optional): Upload size limit, mp4 bitrates are capped to fit it
+        threads (int, optional): Threads used by ffmpeg, 0 lets ffmpeg decide
+    """
+
+    format: str = "mp4"
+    crf: int = 23
+    speed: str = "veryfast"
+    quality: int = 75
+    lossless: bool = False
+    max_fps: float = None
+    max_still: float = None
+    max_size_mb: float = None
+    threads: int = 0
+
+    @property
+    def extension(self):
+        """The file extension of the format"""
+        return f".{self.format}"
+
+    def ffmpeg_options(self, duration=None, drop_duplicates=False, hold=0):
+        """Returns the codec, output pixel format and ffmpeg options of the profile
+
+        Args:
+            duration (float, optional): Length of the video in seconds, needed to cap the bitrate
+            drop_duplicates (bool, optional): Shows repeated frames as one longer frame
+            hold (float, optional): Seconds the last frame stays on screen after it is shown
+        """
+        options = ["-threads", str(self.threads)]
+        filters = []
+        if drop_duplicates:
+            # Only exact repeats are dropped, the timestamps of the rest are kept
+            filters.append("mpdecimate=hi=0:lo=0:frac=0")
+            options += ["-fps_mode", "vfr"]
+        if self.format == "gif":
+            # A palette per frame keeps the colours exact without buffering the whole video
+            filters.append(
+                "split[frames][palette];"
+                "[palette]palettegen=stats_mode=single:reserve_transparent=0[palette];"
+                "[frames][palette]paletteuse=new=1:dither=none"
+            )
+            options += ["-filter_complex", ",".join(filters), "-loop", "0"]
+            if hold:
+                options += ["-final_delay", str(max(round(hold * 100), 2))]
+            return "gif", "pal8", options
+        if hold:
+            # A repeat of the last frame would be dropped, leaving nothing to time it by
+            filters.append(f"tpad=stop_mode=clone:stop_duration={hold:.3f}")
+        if filters:
+            options += ["-vf", ",".join(filters)]
+        if self.format == "webp":
+            if self.lossless:
+                options += ["-lossless", "1"]
+            else:
+                options += ["-quality", str(self.quality)]
+            return "libwebp_anim", "bgra", options + ["-loop", "0"]
+        if self.format != "mp4":
+            raise ValueError(f"Unknown video format {self.format}")
+
+        if self.lossless:
+            return "libx264", "yuv444p", options + ["-preset", self.speed, "-qp", "0"]
+        options += ["-preset", self.speed, "-crf", str(self.crf), "-tune", "animation"]
+        if self.max_size_mb and duration:
+            # Leaves some room for the container
+            bitrate = int(self.max_size_mb * 8_000_000 * 0.95 / duration)
+            options += ["-maxrate", str(bitrate), "-bufsize", str(bitrate * 2)]
+        return "libx264", "yuv420p", options
+
+
+PRESETS = {
+    "h264": EncodingProfile(max_fps=60, max_still=0.5, max_size_mb=40),
+    "h264-small": EncodingProfile(
+        crf=30, speed="faster", max_fps=30, max_still=0.25, max_size_mb=8
+    ),
+    "gif": EncodingProfile("gif", max_fps=50, max_still=0.5, max_size_mb=16),
+    "webp": EncodingProfile("webp", lossless=True, max_fps=60, max_still=0.5, max_size_mb=16),
+}
+
+
+def encoding_profile(config):
+    """Builds a profile from the [video] section of the config
+
+    The preset (h264 by default) is the starting point, any other key
+    overrides one of its settings.
+    """
+    config = dict(config)
+    profile = PRESETS[config.pop("preset", "h264")]
+    known = {field.name for field in fields(EncodingProfile)}
+    unknown = set(config) - known
+    if unknown:
+        raise ValueError(f"Unknown [video] settings: {', '.join(sorted(unknown))}")
+    return replace(profile, **config)
+
+
+def resample_runs(runs, step):
+    """Returns how often each frame of a sequence of runs is shown when keeping every step-th frame
+
+    Args:
+        runs (list): Number of times each frame is shown
+        step (int): Keeps one frame out of every step
+    """
+    resampled = []
+    start = 0
+    for run in runs:
+        end = start + run
+        # The kept frames are the multiples of step, count those within the run
+        resampled.append((end + step - 1) // step - (start + step - 1) // step)
+        start = end
+    return resampled
+
+
+def repeat_runs(frames, runs):
+    """Yields each frame as many times as its run, without copying it"""
+    for frame, run in zip(frames, runs):
+        for _ in range(run):
+            yield frame
+
+
+def composite_runs(compositor, runs):
+    """Composites (frame, run) pairs, yielding each combined frame run times
+
+    Like Compositor.composite, the yielded arrays are reused.
+    """
+    pending = deque()
+
+    def frames():
+        for frame, run in runs:
+            pending.append(run)
+            yield frame
+
+    for composited in compositor.composite(frames()):
+        yield from repeat(composited, pending.popleft())
+
+
+def write_video(frames, save_path, fps=120, profile=None, frame_count=None,
+                drop_duplicates=False, hold=0):
+    """Encodes the frames into a video file as they are produced
+
+    Args:
+        frames (iterable): Equally sized RGB frames as uint8 arrays
+        save_path (str): Where the video is written
+        fps (int, optional): Frames per second of the video. Defaults to 120
+        profile (EncodingProfile, optional): How to encode the video. Defaults to H.264
+        frame_count (int, optional): The number of frames, if known, to cap the bitrate
+        drop_duplicates (bool, optional): Encodes repeated frames as one longer frame
+        hold (float, optional): Seconds the last frame stays on screen after it is shown
+
+    Returns:
+        int: The number of frames written, no file is created if this is 0
+    """
+    # Only imported when a video is made, turns without videos never need ffmpeg
+    import imageio_ffmpeg  # pylint: disable=import-outside-toplevel
+
+    profile = profile or EncodingProfile()
+    frames = iter(frames)
+    first = next(frames, None)
+    if first is None:
+        return 0
+
+    height, width = first.shape[:2]
+    codec, pixel_format, options = profile.ffmpeg_options(
+        frame_count and frame_count / fps, drop_duplicates, hold
+    )
+    writer = imageio_ffmpeg.write_frames(
+        save_path,
+        (width, height),
+        pix_fmt_out=pixel_format,
+        fps=fps,
+        codec=codec,
+        quality=None,
+        macro_block_size=2 if profile.format == "mp4" else 1,
+        output_params=options,
+    )
+    writer.send(None)  # Starts the ffmpeg process
+    count = 1
+    try:
+        writer.send(np.ascontiguousarray(first))
+        for frame in frames:
+            writer.send(np.ascontiguousarray(frame))
+            count += 1
+    finally:
+        writer.close()
+
+    size = os.path.getsize(save_path)
+    metrics.count("video_bytes", size, format=profile.format)
+    if profile.max_size_mb and size > profile.max_size_mb * 1_000_000:
+        print(f"{save_path} is {size / 1_000_000:.1f} MB, over the {profile.max_size_mb} MB limit")
+        metrics.count("oversized_videos", format=profile.format)
+    return count
@@ -0,0 +1,132 @@
+"""
+    Counts votes for the next button from several polls and from replies and mentions
+"""
+
+import html
+import re
+from collections import Counter
+
+
+TAG = re.compile(r"<[^>]+>")
+# Mastodon renders mentions (and hashtags) as links split into several tags, like
+# <a href="..." class="u-url mention">@<span>bot</span></a>, so they go before the other tags
+MENTION_LINK = re.compile(r"<a\b[^>]*\bclass=\"[^\"]*\bmention\b[^\"]*\"[^>]*>.*?</a>", re.DOTALL)
+MENTION = re.compile(r"@\S+")
+
+
+class Tally:
+    """Votes sent as replies or mentions, one per account
+
+    An account's latest command replaces its earlier one, so each new reply is
+    counted in constant time however long the thread gets.
+    """
+
+    def __init__(self):
+        self.counts = Counter()  # button -> votes
+        self.choices = {}  # account id -> button
+
+    def __len__(self):
+        return len(self.choices)
+
+    def add(self, account, button):
+        """Counts an account's vote, moving it if the account voted before"""
+        previous = self.choices.get(account)
+        if previous == button:
+            return
+        if previous is not None:
+            self.counts[previous] -= 1
+        self.choices[account] = button
+        self.counts[button] += 1
+
+
+class VoteCollector:
+    """Combines the polls of a turn with the button commands sent to the bot
+
+    Mentions (replies to the bot's posts included) are read from the
+    notifications a page at a time, starting after the last one seen, so each
+    update only fetches and counts what is new.
+
+    Args:
+        mastodon (Mastodon): The logged in Mastodon client
+        buttons (dict): Poll option titles mapped to the GameBoy method that presses them
+        since_id (str, optional): The last notification already counted. When not known,
+            mentions sent before the first update are skipped
+        replies (bool, optional): Counts commands sent in replies and mentions. Defaults to True
+        page_size (int, optional): Notifications fetched per request. Defaults to 40
+    """
+
+    def __init__(self, mastodon, buttons, since_id=None, replies=True, page_size=40):
+        self.mastodon = mastodon
+        self.buttons = list(buttons)
+        self.since_id = since_id
+        self.replies = replies
+        self.page_size = page_size
+        self.tally = Tally()
+
+        # Every word of an option's title, and the name of its method, selects it
+        self.aliases = {}
+        for title, method in buttons.items():
+            for alias in (title, *title.split(), method.removeprefix("dpad_")):
+                self.aliases[alias.lower()] = title
+
+    def parse(self, content):
+        """Returns the button a post asks for, or None
+
+        Only a post that is a command counts: the text left after the mentions
+        is one alias, or starts with one. Aliases are everyday words ("a",
+        "left", "start"), so one further into a sentence is conversation.
+
+        Args:
+            content (str): The HTML content of the post
+        """
+        text = TAG.sub(" ", MENTION_LINK.sub(" ", content))
+        text = MENTION.sub(" ", html.unescape(text)).lower()
+        words = [word.strip(".,!?") for word in text.split()]
+        words = [word for word in words if word]
+        if not words:
+            return None
+        return self.aliases.get(" ".join(words)) or self.aliases.get(words[0])
+
+    def update(self):
+        """Counts the mentions received since the last update, returns how many were new"""
+        if not self.replies:
+            return 0
+        if self.since_id is None:
+            # Start from the latest notification, earlier mentions belong to earlier turns
+            latest = self.mastodon.notifications(types=["mention"], limit=1)
+            self.since_id = str(latest[0]["id"]) if latest else "0"
+            return 0
+
+        new = 0
+        while True:
+            page = self.mastodon.notifications(
+                types=["mention"], min_id=self.since_id, limit=self.page_size
+            )
+            if not page:
+                break
+            for notification in sorted(page, key=lambda item: int(item["id"])):
+                status = notification.get("status")
+                button = status and self.parse(status["content"])
+                if button:
+                    self.tally.add(notification["account"]["id"], button)
+                    new += 1
+            self.since_id = str(max(int(notification["id"]) for notification in page))
+            if len(page) < self.page_size:
+                break
+        return new
+
+    def results(self, polls):
+        """Returns the votes for each button, in the format of a poll's options
+
+        Args:
+            polls (list): The polls of the turn, their votes are added to the replies
+        """
+        counts = Counter(self.tally.counts)
+        for poll in polls:
+            for option in poll["options"]:
+                counts[option["title"].strip()] += option["votes_count"] or 0
+        return [{"title": button, "votes_count": counts[button]} for button in self.buttons]
+
+    def next_turn(self):
+        """Starts counting the votes of the next turn"""
+        self.tally = Tally()